@@ -1,36 +1,55 @@
+import asyncio
 import discord
 from discord.ext import commands
-from flask import Flask
 import json
-import aiosqlite
-import os
-import threading
-from datetime import datetime
+import re
+import typing
+from datetime import datetime, timedelta, timezone
 
-# --- Fake web server for Render ---
-app = Flask(__name__)
+from runtime import OWNER_ID, PRIORITY_CLASSES, has_control_perms, load_role_members
+from rules import RULES, RESPONSES
 
-@app.route('/')
-def home():
-    return "Bot is running!"
+# Members scanned by !massban match between yields to the event loop
+SCAN_YIELD_EVERY = 5000
+MASSBAN_CONFIRM_TIMEOUT = 30
 
-def run_web():
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
+class Duration(commands.Converter):
+    """Parse durations such as 30m, 12h or 1d12h into a timedelta"""
+    UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    
+    async def convert(self, ctx, argument):
+        parts = re.findall(r'(\d+)([smhdw])', argument.lower())
+        if not parts or ''.join(n + u for n, u in parts) != argument.lower():
+            raise commands.BadArgument(f"Invalid duration: {argument}")
+        seconds = sum(int(n) * self.UNITS[u] for n, u in parts)
+        if seconds <= 0:
+            raise commands.BadArgument(f"Invalid duration: {argument}")
+        return timedelta(seconds=seconds)
+
+class MemberMatch(commands.FlagConverter):
+    """Filters for !massban match; name: may be given several times"""
+    name: typing.List[str] = commands.flag(default=lambda ctx: [])
+    created: typing.Optional[Duration] = None
+    joined: typing.Optional[Duration] = None
+    noavatar: bool = False
 
-def keep_alive():
-    t = threading.Thread(target=run_web)
-    t.start()
+def format_duration(duration):
+    """Render a timedelta the way Duration accepts it"""
+    seconds = int(duration.total_seconds())
+    parts = []
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60), ('s', 1)):
+        if seconds >= size:
+            parts.append(f"{seconds // size}{unit}")
+            seconds %= size
+    return ''.join(parts)
 
 class GuardianCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.rt = bot.runtime
     
     async def get_config(self, guild_id):
-        from bot import configs, Config
-        if guild_id not in configs:
-            configs[guild_id] = await Config.load(guild_id)
-        return configs[guild_id]
+        return await self.rt.get_config(guild_id)
     
     @commands.group(name='guard', invoke_without_command=True)
     @commands.has_permissions(administrator=True)
@@ -41,39 +60,53 @@ class GuardianCommands(commands.Cog):
             description="Protect your server from raids, nukes, and mass deletions",
             color=discord.Color.blue()
         )
-        embed.add_field(name="Setup", value="`!guard logs <#channel>` - Set log channel\n`!guard config` - View configuration\n`!guard alerts` - Manage alert users", inline=False)
-        embed.add_field(name="Protection", value="`!guard lockdown` - Lock server\n`!guard unlock` - Unlock server\n`!guard toggle <feature>` - Enable/disable features", inline=False)
+        embed.add_field(name="Setup", value="`!guard logs <#channel> [webhook|bot]` - Set log channel\n`!guard config` - View configuration\n`!guard alerts` - Manage alert users", inline=False)
+        embed.add_field(name="Protection", value="`!guard lockdown` - Lock server\n`!guard unlock` - Unlock server\n`!guard raidmode <on/off>` - Fast server-wide raid mode\n`!guard preempt <on/off>` - Lock down known raiders on join\n`!guard toggle <feature>` - Enable/disable features\n`!guard rule <feature> <count> <window> [response]` - Tune a rule", inline=False)
         embed.add_field(name="Backups", value="`!backup now` - Create backup\n`!backup list` - List backups", inline=False)
         embed.add_field(name="Whitelist", value="`!whitelist user <add/remove> <@user>` - Manage user whitelist\n`!whitelist bot <add/remove> <bot_id>` - Manage bot whitelist", inline=False)
-        embed.add_field(name="Evidence", value="`!guard evidence <@user>` - View user's actions\n`!guard evidence list` - Recent events\n`!guard actionlog` - View bot actions", inline=False)
-        embed.add_field(name="Tools", value="`!guard scan` - Security scan\n`!guard info` - Bot status\n`!guard healthcheck` - System check", inline=False)
+        embed.add_field(name="Evidence", value="`!guard evidence <@user>` - View user's actions\n`!guard evidence list` - Recent events\n`!guard actionlog` - View bot actions\n`!guard stats [YYYY-MM]` - Raid statistics\n`!guard export [hours] [ndjson/csv]` - Download full records", inline=False)
+        embed.add_field(name="Tools", value="`!guard scan` - Security scan\n`!guard info` - Bot status\n`!guard healthcheck` - System check\n`!guard shards` - Process metrics\n`!guard retention [days]` - Data retention", inline=False)
         await ctx.send(embed=embed)
     
     @guard.command(name='logs')
     @commands.has_permissions(administrator=True)
-    async def set_logs(self, ctx, channel: discord.TextChannel):
-        """Set or update the log channel"""
+    async def set_logs(self, ctx, channel: discord.TextChannel, mode: str = None):
+        """Set or update the log channel: !guard logs <#channel> [webhook|bot]"""
         config = await self.get_config(ctx.guild.id)
 
+        if mode is not None and mode.lower() not in ('webhook', 'bot'):
+            await ctx.send("Use: `!guard logs <#channel> [webhook|bot]`")
+            return
+        # Without a mode, keep whichever delivery is in use
+        use_webhook = mode.lower() == 'webhook' if mode else bool(config.log_webhook_url)
+
         # If it's already set to the same channel, tell them
-        if config.log_channel_id == channel.id:
+        if config.log_channel_id == channel.id and use_webhook == bool(config.log_webhook_url):
             await ctx.send(f" Logs are already set to {channel.mention}")
             return
 
+        webhook_url = None
+        if use_webhook:
+            try:
+                webhook_url = await self.rt.log_webhook_for(channel)
+            except discord.HTTPException as e:
+                await ctx.send(f" Could not set up a log webhook in {channel.mention}: {e}")
+                return
+
         # Update it
         old_channel = ctx.guild.get_channel(config.log_channel_id) if config.log_channel_id else None
         config.log_channel_id = channel.id
+        config.log_webhook_url = webhook_url
         await config.save()
 
         # Update in-memory cache immediately
-        from bot import configs
-        configs[ctx.guild.id] = config
+        self.rt.configs[ctx.guild.id] = config
 
         # Confirm to user
         if old_channel:
-            await ctx.send(f" Log channel updated from {old_channel.mention} to {channel.mention}")
+            await ctx.send(f" Log channel updated from {old_channel.mention} to {channel.mention} ({'webhook' if webhook_url else 'bot'} delivery)")
         else:
-            await ctx.send(f" Log channel set to {channel.mention}")
+            await ctx.send(f" Log channel set to {channel.mention} ({'webhook' if webhook_url else 'bot'} delivery)")
 
     
     @guard.command(name='config')
@@ -83,7 +116,7 @@ class GuardianCommands(commands.Cog):
         config = await self.get_config(ctx.guild.id)
         
         embed = discord.Embed(title="Guardian Configuration", color=discord.Color.blue())
-        embed.add_field(name="Log Channel", value=f"<#{config.log_channel_id}>" if config.log_channel_id else "Not set", inline=False)
+        embed.add_field(name="Log Channel", value=(f"<#{config.log_channel_id}> via {'webhook' if config.log_webhook_url else 'bot'}") if config.log_channel_id else "Not set", inline=False)
         embed.add_field(name="Lockdown", value="Active" if config.lockdown_active else "Inactive", inline=True)
         embed.add_field(name="Whitelisted Users", value=str(len(config.whitelist_users)), inline=True)
         embed.add_field(name="Whitelisted Bots", value=str(len(config.whitelist_bots)), inline=True)
@@ -97,7 +130,8 @@ class GuardianCommands(commands.Cog):
                 status = "ON"
             
             if 'window' in settings:
-                features.append(f"{feature}: {status} ({settings['count']} in {settings['window']}s)")
+                response = f", {settings.get('response', RULES[feature][2])}" if feature in RULES else ""
+                features.append(f"{feature}: {status} ({settings['count']} in {settings['window']}s{response})")
             else:
                 features.append(f"{feature}: {status}")
         
@@ -109,11 +143,11 @@ class GuardianCommands(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def toggle_feature(self, ctx, feature: str, state: str = None):
         """Toggle detection features on/off
-        Usage: !guard toggle <channel_delete|role_delete|member_kick|member_ban|bot_join> <on|off>
+        Usage: !guard toggle <feature> <on|off> (see !guard config for features)
         """
         config = await self.get_config(ctx.guild.id)
         
-        valid_features = ['channel_delete', 'role_delete', 'member_kick', 'member_ban', 'bot_join']
+        valid_features = list(RULES) + ['permission_grant', 'invite_spike']
         
         if feature not in valid_features:
             await ctx.send(f"Invalid feature. Valid features: {', '.join(valid_features)}")
@@ -141,6 +175,31 @@ class GuardianCommands(commands.Cog):
         else:
             await ctx.send("Use 'on' or 'off'")
     
+    @guard.command(name='rule')
+    @commands.has_permissions(administrator=True)
+    async def set_rule(self, ctx, feature: str, count: int, window: int, response: str = None):
+        """Set a detection rule's threshold and response
+        Usage: !guard rule <feature> <count> <window_seconds> [auto|lockdown|ban|alert]
+        """
+        if feature not in RULES or feature == 'bot_join':
+            await ctx.send(f"Invalid feature. Valid features: {', '.join(f for f in RULES if f != 'bot_join')}")
+            return
+        if count < 1 or window < 1:
+            await ctx.send("Count and window must be at least 1")
+            return
+        if response is not None and response not in RESPONSES[:4]:
+            await ctx.send(f"Invalid response. Valid responses: {', '.join(RESPONSES[:4])}")
+            return
+        
+        config = await self.get_config(ctx.guild.id)
+        settings = config.thresholds.setdefault(feature, {'enabled': True})
+        settings['count'] = count
+        settings['window'] = window
+        if response is not None:
+            settings['response'] = response
+        await config.save()
+        await ctx.send(f"{feature}: {count} in {window}s, response {settings.get('response', RULES[feature][2])}")
+    
     @guard.command(name='lockdown')
     @commands.has_permissions(administrator=True)
     async def lockdown(self, ctx):
@@ -151,20 +210,14 @@ class GuardianCommands(commands.Cog):
             await ctx.send("Server is already in lockdown")
             return
         
-        locked_count = 0
-        for channel in ctx.guild.text_channels:
-            try:
-                await channel.set_permissions(ctx.guild.default_role, send_messages=False)
-                locked_count += 1
-            except:
-                pass
+        locked_count, failed_count = await self.rt.lock_channels(ctx.guild, f"Server lockdown by {ctx.author}")
         
         config.lockdown_active = True
         await config.save()
         
         embed = discord.Embed(
             title="SERVER LOCKDOWN ACTIVATED",
-            description=f"All text channels have been locked.\n**Locked channels:** {locked_count}",
+            description=f"All text channels have been locked.\n**Locked channels:** {locked_count}" + (f"\n**Failed:** {failed_count}" if failed_count else ""),
             color=discord.Color.red(),
             timestamp=datetime.utcnow()
         )
@@ -183,47 +236,122 @@ class GuardianCommands(commands.Cog):
             await ctx.send("Server is not in lockdown")
             return
         
-        unlocked_count = 0
-        for channel in ctx.guild.text_channels:
-            try:
-                await channel.set_permissions(ctx.guild.default_role, send_messages=None)
-                unlocked_count += 1
-            except:
-                pass
+        unlocked_count, failed_count = await self.rt.unlock_channels(ctx.guild, f"Server unlocked by {ctx.author}")
         
         config.lockdown_active = False
         await config.save()
         
         embed = discord.Embed(
             title="SERVER UNLOCKED",
-            description=f"All text channels have been unlocked.\n**Unlocked channels:** {unlocked_count}",
+            description=f"Channel permissions restored to their pre-lockdown state.\n**Restored channels:** {unlocked_count}" + (f"\n**Failed:** {failed_count}" if failed_count else ""),
             color=discord.Color.green(),
             timestamp=datetime.utcnow()
         )
         
         await ctx.send(embed=embed)
     
+    @guard.command(name='preempt')
+    @commands.has_permissions(administrator=True)
+    async def preempt(self, ctx, state: str = None):
+        """Lock down known raiders from other servers as they join: !guard preempt <on/off>"""
+        config = await self.get_config(ctx.guild.id)
+        
+        if state is None:
+            await ctx.send(
+                f"Pre-emptive lockdown is {'ON' if config.preempt_offenders else 'OFF'} "
+                f"({len(self.rt.offenders)} known raiders across protected servers)"
+            )
+            return
+        
+        if state.lower() not in ('on', 'off'):
+            await ctx.send("Use: `!guard preempt on` or `!guard preempt off`")
+            return
+        
+        if state.lower() == 'on' and not config.lockdown_role_id:
+            await ctx.send("Set up the lockdown role first with `!lockdown setup`")
+            return
+        
+        config.preempt_offenders = state.lower() == 'on'
+        await config.save()
+        if config.preempt_offenders:
+            await ctx.send("Pre-emptive lockdown enabled. Accounts banned or locked down as raiders in other protected servers will be locked down on join.")
+        else:
+            await ctx.send("Pre-emptive lockdown disabled. Known raiders will only be reported in the log channel.")
+    
+    @guard.command(name='raidmode')
+    @commands.has_permissions(administrator=True)
+    async def raidmode(self, ctx, state: str = None):
+        """Close the whole server with guild-level settings: !guard raidmode <on/off>"""
+        if state is None or state.lower() not in ('on', 'off'):
+            snapshot = await self.rt.get_raid_snapshot(ctx.guild.id)
+            await ctx.send(f"Raid mode is {'active' if snapshot else 'inactive'}. Use `!guard raidmode on` or `!guard raidmode off`")
+            return
+        
+        if state.lower() == 'on':
+            success, message = await self.rt.enable_raid_mode(ctx.guild, f"Raid mode enabled by {ctx.author}")
+            if not success:
+                await ctx.send(f" Failed: {message}")
+                return
+            embed = discord.Embed(
+                title="RAID MODE ACTIVATED",
+                description="Verification raised to High, invites paused and @everyone can no longer post, react, create threads or join voice.",
+                color=discord.Color.red(),
+                timestamp=datetime.utcnow()
+            )
+            embed.add_field(name="Note", value="Channels with an explicit @everyone allow overwrite stay open; use `!guard lockdown` for those", inline=False)
+            embed.add_field(name="Disable", value="Use `!guard raidmode off` to restore the previous settings", inline=False)
+            await ctx.send(embed=embed)
+        else:
+            success, message = await self.rt.disable_raid_mode(ctx.guild, f"Raid mode disabled by {ctx.author}")
+            if not success:
+                await ctx.send(f" Failed: {message}")
+                return
+            embed = discord.Embed(
+                title="RAID MODE DISABLED",
+                description="Verification level, invites and @everyone permissions restored.",
+                color=discord.Color.green(),
+                timestamp=datetime.utcnow()
+            )
+            await ctx.send(embed=embed)
+    
     @guard.command(name='scan')
     @commands.has_permissions(administrator=True)
     async def scan(self, ctx):
         """Run security scan"""
         config = await self.get_config(ctx.guild.id)
+        await self.rt.ensure_chunked(ctx.guild)
         
         embed = discord.Embed(title="Security Scan Results", color=discord.Color.blue())
         
-        admin_users = [m for m in ctx.guild.members if m.guild_permissions.administrator and not m.bot]
+        admin_users = [m for m in self.rt.perm_index.privileged_members(ctx.guild) if m.guild_permissions.administrator and not m.bot]
         embed.add_field(name="Admin Users", value=str(len(admin_users)), inline=True)
         
-        bots = [m for m in ctx.guild.members if m.bot]
+        bots = self.rt.perm_index.bots(ctx.guild)
         unverified_bots = [b for b in bots if not b.public_flags.verified_bot and b.id not in config.whitelist_bots]
         embed.add_field(name="Total Bots", value=str(len(bots)), inline=True)
         embed.add_field(name="Unverified Bots", value=str(len(unverified_bots)), inline=True)
         
-        async with aiosqlite.connect('guardian.db') as db:
+        async with self.rt.db() as db:
             async with db.execute('SELECT COUNT(*) FROM backups WHERE guild_id = ?', (ctx.guild.id,)) as cursor:
                 result = await cursor.fetchone()
                 backup_count = result[0] if result else 0
         embed.add_field(name="Backups", value=str(backup_count), inline=True)
+
+        # Live rows plus the daily rollups left behind by the retention job
+        async with self.rt.db() as db:
+            async with db.execute('''
+                SELECT COUNT(*), COALESCE(SUM(json_extract(data, '$.is_mass')), 0) FROM evidence WHERE guild_id = ?
+            ''', (ctx.guild.id,)) as cursor:
+                live_events, live_mass = await cursor.fetchone()
+            async with db.execute('''
+                SELECT COALESCE(SUM(count), 0), COALESCE(SUM(mass_count), 0) FROM evidence_daily WHERE guild_id = ?
+            ''', (ctx.guild.id,)) as cursor:
+                archived_events, archived_mass = await cursor.fetchone()
+        embed.add_field(
+            name="Recorded Events",
+            value=f"{live_events + archived_events} ({live_mass + archived_mass} mass)",
+            inline=True
+        )
         
         bot_member = ctx.guild.get_member(self.bot.user.id)
         has_admin = bot_member.guild_permissions.administrator
@@ -249,7 +377,6 @@ class GuardianCommands(commands.Cog):
         config = await self.get_config(ctx.guild.id)
         bot_member = ctx.guild.get_member(self.bot.user.id)
         
-        from bot import has_control_perms
         mode = "Full Control" if has_control_perms(ctx.guild, bot_member) else "Monitor Only"
         
         embed = discord.Embed(title="Guardian Bot Status", color=discord.Color.blue())
@@ -311,8 +438,6 @@ class GuardianCommands(commands.Cog):
         !guard exempt remove @user - Remove user from exemption list
         !guard exempt list - Show all exempted users
         """
-        from bot import OWNER_ID
-        
         if ctx.author.id != OWNER_ID:
             await ctx.send("This command can only be used by the bot owner")
             return
@@ -360,22 +485,105 @@ class GuardianCommands(commands.Cog):
         embed.add_field(name="View Audit Log", value="Yes" if perms.view_audit_log else "No", inline=True)
         
         try:
-            async with aiosqlite.connect('guardian.db') as db:
+            async with self.rt.db() as db:
                 await db.execute('SELECT 1')
             embed.add_field(name="Database", value="Connected", inline=True)
         except:
             embed.add_field(name="Database", value="Error", inline=True)
         
         embed.add_field(name="API Latency", value=f"{round(self.bot.latency * 1000)}ms", inline=True)
+
+        if self.rt.maintenance_stats:
+            embed.add_field(
+                name="Last Maintenance",
+                value=f"{self.rt.maintenance_stats['finished'][:19]} UTC\nReclaimed {self.rt.maintenance_stats['reclaimed_bytes'] // 1024} KB",
+                inline=True
+            )
+
+        rest = self.rt.rest
+        queued = rest.queued()
+        known, exhausted = rest.budget(self.bot.http)
+        embed.add_field(
+            name="REST Scheduler",
+            value="\n".join(
+                f"{name}: {rest.completed[i]} done, {queued[i]} queued, max wait {int(rest.max_wait[i] * 1000)}ms"
+                for i, name in enumerate(PRIORITY_CLASSES)
+            ),
+            inline=False
+        )
+        ratelimits = rest.ratelimits
+        top = "\n".join(f"`{route}`: {count}" for route, count in ratelimits.buckets.most_common(5))
+        embed.add_field(
+            name="Rate Limits",
+            value=(
+                f"429s: {sum(ratelimits.buckets.values())} | Global: {ratelimits.global_hits}\n"
+                f"Buckets: {known} known, {exhausted} exhausted"
+                + (f"\nLast 429: {ratelimits.last_hit.isoformat()[:19]} UTC" if ratelimits.last_hit else "")
+                + (f"\n{top}" if top else "")
+            )[:1024],
+            inline=False
+        )
         
         await ctx.send(embed=embed)
+
+    @guard.command(name='shards')
+    @commands.has_permissions(administrator=True)
+    async def shards(self, ctx):
+        """Show per-process shard metrics"""
+        async with self.rt.db() as db:
+            async with db.execute('''
+                SELECT cluster_id, pid, shard_ids, guilds, latency_ms, events_per_min, loop_lag_ms, rss_kb, uptime, updated_at
+                FROM process_metrics
+                ORDER BY cluster_id
+            ''') as cursor:
+                rows = await cursor.fetchall()
+
+        if not rows:
+            await ctx.send("No process metrics recorded yet")
+            return
+
+        embed = discord.Embed(title="Shard Processes", color=discord.Color.blue())
+        embed.add_field(name="This Server", value=f"Shard {ctx.guild.shard_id} on process {self.rt.cluster_id}", inline=False)
+        for cluster_id, pid, shard_ids, guilds, latency_ms, events_per_min, loop_lag_ms, rss_kb, uptime, updated_at in rows[:20]:
+            embed.add_field(
+                name=f"Process {cluster_id} (PID {pid})",
+                value=(
+                    f"Shards: {shard_ids}\nGuilds: {guilds}\nLatency: {latency_ms}ms\n"
+                    f"Events: {events_per_min}/min\nLoop lag: {loop_lag_ms}ms\n"
+                    f"Memory: {rss_kb // 1024} MB\nUptime: {uptime // 60} min\nUpdated: {updated_at[11:19]} UTC"
+                ),
+                inline=True
+            )
+
+        await ctx.send(embed=embed)
+
+    @guard.command(name='retention')
+    @commands.has_permissions(administrator=True)
+    async def retention(self, ctx, days: int = None):
+        """Show or set how many days of evidence, logs and backups are kept
+        Usage: !guard retention [days] - use 0 to keep everything
+        """
+        config = await self.get_config(ctx.guild.id)
+
+        if days is None:
+            kept = f"{config.retention_days} days" if config.retention_days > 0 else "forever"
+            await ctx.send(f"Records are kept for {kept}. Older rows are rolled up into daily totals.")
+            return
+
+        if days < 0:
+            await ctx.send("Retention must be 0 or more days")
+            return
+
+        config.retention_days = days
+        await config.save()
+        await ctx.send(f"Retention set to {days} days" if days else "Retention disabled - records are kept forever")
     
     @guard.command(name='evidence')
     @commands.has_permissions(administrator=True)
     async def evidence(self, ctx, user: discord.User = None):
         """View evidence for a user or list recent events"""
         if user:
-            async with aiosqlite.connect('guardian.db') as db:
+            async with self.rt.db() as db:
                 async with db.execute('''
                     SELECT action_type, timestamp, data
                     FROM evidence
@@ -404,7 +612,7 @@ class GuardianCommands(commands.Cog):
             
             await ctx.send(embed=embed)
         else:
-            async with aiosqlite.connect('guardian.db') as db:
+            async with self.rt.db() as db:
                 async with db.execute('''
                     SELECT user_id, action_type, timestamp
                     FROM evidence
@@ -432,7 +640,7 @@ class GuardianCommands(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def actionlog(self, ctx, limit: int = 10):
         """View bot's actions taken against raids"""
-        async with aiosqlite.connect('guardian.db') as db:
+        async with self.rt.db() as db:
             async with db.execute('''
                 SELECT user_id, action_type, target, timestamp, bot_action, details
                 FROM action_log
@@ -453,12 +661,121 @@ class GuardianCommands(commands.Cog):
                 value=f"User: <@{user_id}>\nTarget: {target}\nDetails: {details}\nTime: {timestamp}",
                 inline=False
             )
-        
+
         await ctx.send(embed=embed)
 
+    @guard.command(name='stats')
+    @commands.has_permissions(administrator=True)
+    async def stats(self, ctx, month: str = None):
+        """Raid statistics from the precomputed rollups
+        Usage: !guard stats [YYYY-MM]
+        """
+        now = datetime.utcnow()
+        month = month or now.strftime('%Y-%m')
+        try:
+            datetime.strptime(month, '%Y-%m')
+        except ValueError:
+            await ctx.send("Month must look like `2024-05`")
+            return
+
+        async with self.rt.db() as db:
+            async with db.execute('''
+                SELECT action_type, count, raid_count, response_ms, response_count
+                FROM action_stats_monthly
+                WHERE guild_id = ? AND month = ?
+                ORDER BY count DESC
+            ''', (ctx.guild.id, month)) as cursor:
+                by_type = await cursor.fetchall()
+            async with db.execute('''
+                SELECT user_id, count, raid_count
+                FROM offender_stats_monthly
+                WHERE guild_id = ? AND month = ?
+                ORDER BY raid_count DESC, count DESC
+                LIMIT 5
+            ''', (ctx.guild.id, month)) as cursor:
+                offenders = await cursor.fetchall()
+            async with db.execute('''
+                SELECT bot_action, SUM(count)
+                FROM action_stats_hourly
+                WHERE guild_id = ? AND hour >= ?
+                GROUP BY bot_action
+                ORDER BY 2 DESC
+            ''', (ctx.guild.id, (now - timedelta(hours=24)).isoformat()[:13])) as cursor:
+                last_day = await cursor.fetchall()
+
+        if not by_type:
+            await ctx.send(f"No recorded events for {month}")
+            return
+
+        events = sum(row[1] for row in by_type)
+        raids = sum(row[2] for row in by_type)
+        response_ms = sum(row[3] for row in by_type)
+        responses = sum(row[4] for row in by_type)
+
+        embed = discord.Embed(title=f"Raid Statistics - {month}", color=discord.Color.blue())
+        embed.add_field(name="Raid Events", value=str(raids), inline=True)
+        embed.add_field(name="Total Events", value=str(events), inline=True)
+        embed.add_field(
+            name="Avg Response",
+            value=f"{response_ms / responses / 1000:.1f}s" if responses else "n/a",
+            inline=True
+        )
+        embed.add_field(
+            name="By Type",
+            value="\n".join(f"{action_type}: {count} ({raid_count} raid)" for action_type, count, raid_count, _, _ in by_type),
+            inline=False
+        )
+        if offenders:
+            embed.add_field(
+                name="Top Offenders",
+                value="\n".join(f"<@{user_id}> - {raid_count} raid / {count} total" for user_id, count, raid_count in offenders),
+                inline=False
+            )
+        if last_day:
+            embed.add_field(
+                name="Bot Actions (24h)",
+                value="\n".join(f"{bot_action}: {count}" for bot_action, count in last_day),
+                inline=False
+            )
+
+        await ctx.send(embed=embed)
+
+    @guard.command(name='export')
+    @commands.has_permissions(administrator=True)
+    async def export(self, ctx, hours: int = 24, fmt: str = 'ndjson'):
+        """Export evidence and action log as gzip attachments
+        Usage: !guard export [hours] [ndjson|csv] - use 0 hours for the full history
+        """
+
+        fmt = fmt.lower()
+        if fmt not in ('ndjson', 'csv'):
+            await ctx.send("Format must be `ndjson` or `csv`")
+            return
+
+        since = datetime.utcnow() - timedelta(hours=hours) if hours > 0 else None
+        # Leave room for the multipart envelope under the guild upload limit
+        max_bytes = min(ctx.guild.filesize_limit, 8 * 1024 * 1024) - 64 * 1024
+
+        msg = await ctx.send(" Exporting records...")
+        files_sent = 0
+        total_rows = 0
+        async for filename, fp, rows in self.rt.export_records(ctx.guild.id, since, fmt, max_bytes):
+            try:
+                await ctx.send(f"`{filename}` - {rows} rows", file=discord.File(fp, filename=filename))
+            finally:
+                fp.close()
+            files_sent += 1
+            total_rows += rows
+
+        if files_sent:
+            await msg.edit(content=f" Export complete: {total_rows} rows in {files_sent} file(s)")
+        else:
+            await msg.edit(content=" No records in that time range")
+
 class BackupCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.rt = bot.runtime
     
     @commands.group(name='backup', invoke_without_command=True)
     @commands.has_permissions(administrator=True)
@@ -470,10 +787,8 @@ class BackupCommands(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def backup_now(self, ctx):
         """Create a backup now"""
-        from bot import create_backup
-        
         msg = await ctx.send("Creating backup...")
-        backup_id = await create_backup(ctx.guild)
+        backup_id = await self.rt.create_backup(ctx.guild)
         
         embed = discord.Embed(
             title="Backup Created",
@@ -486,7 +801,7 @@ class BackupCommands(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def backup_list(self, ctx):
         """List all backups"""
-        async with aiosqlite.connect('guardian.db') as db:
+        async with self.rt.db() as db:
             async with db.execute('''
                 SELECT id, timestamp FROM backups
                 WHERE guild_id = ?
@@ -508,12 +823,10 @@ class BackupCommands(commands.Cog):
 class WhitelistCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.rt = bot.runtime
     
     async def get_config(self, guild_id):
-        from bot import configs, Config
-        if guild_id not in configs:
-            configs[guild_id] = await Config.load(guild_id)
-        return configs[guild_id]
+        return await self.rt.get_config(guild_id)
     
     @commands.group(name='whitelist', invoke_without_command=True)
     @commands.has_permissions(administrator=True)
@@ -582,12 +895,10 @@ class WhitelistCommands(commands.Cog):
 class LockdownCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.rt = bot.runtime
     
     async def get_config(self, guild_id):
-        from bot import configs, Config
-        if guild_id not in configs:
-            configs[guild_id] = await Config.load(guild_id)
-        return configs[guild_id]
+        return await self.rt.get_config(guild_id)
     
     @commands.group(name='lockdown', invoke_without_command=True)
     @commands.has_permissions(administrator=True)
@@ -599,8 +910,9 @@ class LockdownCommands(commands.Cog):
             color=discord.Color.red()
         )
         embed.add_field(name="Setup", value="`!lockdown setup` - Create lockdown role and configure", inline=False)
-        embed.add_field(name="Lock User", value="`!lockdown user <@user>` - Lock down a user (invisible)", inline=False)
+        embed.add_field(name="Lock User", value="`!lockdown user <@user> [duration]` - Lock down a user (invisible), e.g. `30m`, `12h`, `7d`", inline=False)
         embed.add_field(name="Unlock User", value="`!lockdown unlock <@user>` - Unlock a user", inline=False)
+        embed.add_field(name="Bulk", value="`!lockdown users [duration] <@user...>` - Lock down several users\n`!lockdown role <@role> [duration]` - Lock down a role's members\n`!lockdown unlockall` - Unlock everyone", inline=False)
         embed.add_field(name="Auto Mode", value="`!lockdown auto <on/off>` - Auto-lockdown raiders", inline=False)
         embed.add_field(name="List Locked", value="`!lockdown list` - Show locked users", inline=False)
         await ctx.send(embed=embed)
@@ -629,28 +941,13 @@ class LockdownCommands(commands.Cog):
                 config.lockdown_role_id = lockdown_role.id
                 await config.save()
             
-            # Configure all channels to deny permissions for this role
-            channels_configured = 0
-            for channel in ctx.guild.channels:
-                try:
-                    # Deny everything - make them completely invisible
-                    await channel.set_permissions(
-                        lockdown_role,
-                        view_channel=False,
-                        send_messages=False,
-                        read_messages=False,
-                        connect=False,
-                        speak=False,
-                        add_reactions=False,
-                        reason="Guardian lockdown setup"
-                    )
-                    channels_configured += 1
-                except:
-                    pass
+            # Deny everything on every channel, skipping ones already configured
+            checked, patched, failed = await self.rt.reconcile_lockdown_overwrites(ctx.guild, "Guardian lockdown setup")
+            channels_configured = checked - failed
             
             embed = discord.Embed(
                 title=" Lockdown Role Configured",
-                description=f"Role: {lockdown_role.mention}\nChannels configured: {channels_configured}",
+                description=f"Role: {lockdown_role.mention}\nChannels configured: {channels_configured} ({patched} updated)",
                 color=discord.Color.green()
             )
             embed.add_field(
@@ -670,11 +967,9 @@ class LockdownCommands(commands.Cog):
     
     @lockdown.command(name='user')
     @commands.has_permissions(administrator=True)
-    async def lockdown_user(self, ctx, user: discord.User):
-        """Lock down a specific user (Wick-style)"""
-        from bot import lockdown_user as lock_user_func
-        
-        success, message = await lock_user_func(ctx.guild, user, f"Locked by {ctx.author}")
+    async def lockdown_user(self, ctx, user: discord.User, duration: typing.Optional[Duration] = None):
+        """Lock down a specific user (Wick-style): !lockdown user <@user> [duration]"""
+        success, message = await self.rt.lockdown_user(ctx.guild, user, f"Locked by {ctx.author}", duration)
         
         if success:
             embed = discord.Embed(
@@ -683,6 +978,7 @@ class LockdownCommands(commands.Cog):
                 color=discord.Color.red()
             )
             embed.add_field(name="Status", value="User cannot see or access anything", inline=False)
+            embed.add_field(name="Duration", value=format_duration(duration) if duration else "Permanent", inline=True)
             embed.add_field(name="Unlock", value=f"`!lockdown unlock {user.mention}`", inline=False)
             await ctx.send(embed=embed)
         else:
@@ -692,9 +988,7 @@ class LockdownCommands(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def lockdown_unlock(self, ctx, user: discord.User):
         """Unlock a user from lockdown"""
-        from bot import unlock_user
-        
-        success, message = await unlock_user(ctx.guild, user)
+        success, message = await self.rt.unlock_user(ctx.guild, user)
         
         if success:
             embed = discord.Embed(
@@ -706,6 +1000,68 @@ class LockdownCommands(commands.Cog):
         else:
             await ctx.send(f" Failed: {message}")
     
+    async def send_bulk_result(self, ctx, title, done, failed, color):
+        """Summarise a bulk lockdown/unlock"""
+        embed = discord.Embed(
+            title=title,
+            description=f"Succeeded: {len(done)} | Failed: {len(failed)}",
+            color=color
+        )
+        if done:
+            users_list = "\n".join([f"<@{uid}>" for uid in done[:20]])
+            if len(done) > 20:
+                users_list += f"\n...and {len(done) - 20} more"
+            embed.add_field(name="Users", value=users_list, inline=False)
+        if failed:
+            errors = "\n".join([f"<@{uid}>: {error}" for uid, error in list(failed.items())[:10]])
+            embed.add_field(name="Failures", value=errors[:1024], inline=False)
+        await ctx.send(embed=embed)
+    
+    @lockdown.command(name='users')
+    @commands.has_permissions(administrator=True)
+    async def lockdown_users(self, ctx, duration: typing.Optional[Duration] = None, *users: discord.User):
+        """Lock down several users at once: !lockdown users [duration] <@user> <@user> ..."""
+        if not users:
+            await ctx.send("Usage: `!lockdown users [duration] <@user> <@user> ...`")
+            return
+        
+        msg = await ctx.send(f" Locking down {len(users)} users...")
+        locked, failed = await self.rt.lockdown_users(ctx.guild, users, f"Locked by {ctx.author}", duration)
+        await msg.delete()
+        await self.send_bulk_result(ctx, " Users Locked Down", locked, failed, discord.Color.red())
+    
+    @lockdown.command(name='role')
+    @commands.has_permissions(administrator=True)
+    async def lockdown_role(self, ctx, role: discord.Role, duration: typing.Optional[Duration] = None):
+        """Lock down every member of a role: !lockdown role <@role> [duration]"""
+        await self.rt.ensure_chunked(ctx.guild)
+        
+        members = [m for m in role.members if m.id not in (ctx.guild.owner_id, self.bot.user.id, ctx.author.id)]
+        if not members:
+            await ctx.send(f"No members to lock down in {role.mention}")
+            return
+        
+        msg = await ctx.send(f" Locking down {len(members)} members of {role.name}...")
+        locked, failed = await self.rt.lockdown_users(ctx.guild, members, f"Role lockdown by {ctx.author}: {role.name}", duration)
+        await msg.delete()
+        await self.send_bulk_result(ctx, f" Role Locked Down: {role.name}", locked, failed, discord.Color.red())
+    
+    @lockdown.command(name='unlockall')
+    @commands.has_permissions(administrator=True)
+    async def lockdown_unlockall(self, ctx):
+        """Unlock every locked user"""
+        config = await self.get_config(ctx.guild.id)
+        
+        if not config.locked_users:
+            await ctx.send("No users are currently locked down")
+            return
+        
+        users = [discord.Object(id=uid) for uid in config.locked_users]
+        msg = await ctx.send(f" Unlocking {len(users)} users...")
+        unlocked, failed = await self.rt.unlock_users(ctx.guild, users, f"Unlocked by {ctx.author}")
+        await msg.delete()
+        await self.send_bulk_result(ctx, " Users Unlocked", unlocked, failed, discord.Color.green())
+    
     @lockdown.command(name='auto')
     @commands.has_permissions(administrator=True)
     async def lockdown_auto(self, ctx, state: str):
@@ -740,13 +1096,21 @@ class LockdownCommands(commands.Cog):
             return
         
         embed = discord.Embed(title=" Locked Down Users", color=discord.Color.red())
-        users_list = "\n".join([f"<@{uid}>" for uid in config.locked_users])
-        embed.add_field(name=f"Total: {len(config.locked_users)}", value=users_list, inline=False)
+        lines = []
+        for uid in config.locked_users:
+            expires_at = self.rt.lock_expiries.get((ctx.guild.id, uid))
+            if expires_at:
+                lines.append(f"<@{uid}> - expires {discord.utils.format_dt(expires_at.replace(tzinfo=timezone.utc), 'R')}")
+            else:
+                lines.append(f"<@{uid}>")
+        users_list = "\n".join(lines)
+        embed.add_field(name=f"Total: {len(config.locked_users)}", value=users_list[:1024], inline=False)
         await ctx.send(embed=embed)
 
 class RestoreCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.rt = bot.runtime
     
     @commands.command(name='restore')
     @commands.has_permissions(administrator=True)
@@ -755,7 +1119,7 @@ class RestoreCommands(commands.Cog):
         msg = await ctx.send(f" Restoring backup #{backup_id}...")
         
         try:
-            async with aiosqlite.connect('guardian.db') as db:
+            async with self.rt.db() as db:
                 async with db.execute('''
                     SELECT data FROM backups
                     WHERE id = ? AND guild_id = ?
@@ -771,6 +1135,7 @@ class RestoreCommands(commands.Cog):
             # Restore roles
             roles_restored = 0
             existing_roles = {r.name: r for r in ctx.guild.roles}
+            recreated = {}
             
             for role_data in backup_data.get('roles', []):
                 if role_data['name'] in ['@everyone', '🔒 Locked Down']:
@@ -778,7 +1143,7 @@ class RestoreCommands(commands.Cog):
                 
                 if role_data['name'] not in existing_roles:
                     try:
-                        await ctx.guild.create_role(
+                        recreated[role_data['id']] = await ctx.guild.create_role(
                             name=role_data['name'],
                             permissions=discord.Permissions(role_data['permissions']),
                             color=discord.Color(role_data['color']),
@@ -788,6 +1153,17 @@ class RestoreCommands(commands.Cog):
                     except:
                         pass
             
+            # Give recreated roles back to the members who held them, one request per member
+            assignments = {}
+            for role_id, member_ids in load_role_members(backup_data.get('role_members', {})).items():
+                if role_id in recreated:
+                    for member_id in member_ids:
+                        assignments.setdefault(member_id, []).append(recreated[role_id])
+            members_restored, members_failed = 0, 0
+            if assignments:
+                await msg.edit(content=f" Restoring backup #{backup_id}: reassigning roles to {len(assignments)} members...")
+                members_restored, members_failed = await self.rt.reassign_roles(ctx.guild, assignments, f"Restored from backup #{backup_id}")
+            
             # Restore channels
             channels_restored = 0
             existing_channels = {c.name: c for c in ctx.guild.channels}
@@ -818,11 +1194,12 @@ class RestoreCommands(commands.Cog):
             )
             embed.add_field(name="Roles Restored", value=str(roles_restored), inline=True)
             embed.add_field(name="Channels Restored", value=str(channels_restored), inline=True)
+            if assignments:
+                embed.add_field(name="Role Members Restored", value=f"{members_restored} ({members_failed} failed or left)", inline=True)
             embed.add_field(name="Backup Date", value=backup_data.get('timestamp', 'Unknown'), inline=False)
             
             await msg.edit(content=None, embed=embed)
             # DM alert users about the restoration
-            from bot import send_alert_dm
             alert_embed = discord.Embed(
                 title="SERVER RESTORE COMPLETED",
                 description=f"Backup #{backup_id} was restored in **{ctx.guild.name}** by {ctx.author.mention}",
@@ -831,7 +1208,7 @@ class RestoreCommands(commands.Cog):
             )
             alert_embed.add_field(name="Roles Restored", value=str(roles_restored), inline=True)
             alert_embed.add_field(name="Channels Restored", value=str(channels_restored), inline=True)
-            await send_alert_dm(ctx.guild, alert_embed, 'restore')
+            await self.rt.send_alert_dm(ctx.guild, alert_embed, 'restore')
 
         except Exception as e:
             await msg.edit(content=f" Restore failed: {str(e)}")
@@ -839,6 +1216,7 @@ class RestoreCommands(commands.Cog):
 class AdvancedCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.rt = bot.runtime
     
     @commands.command(name='nuke')
     @commands.has_permissions(administrator=True)
@@ -849,10 +1227,11 @@ class AdvancedCommands(commands.Cog):
             description="Scanning for vulnerabilities...",
             color=discord.Color.blue()
         )
+        await self.rt.ensure_chunked(ctx.guild)
         
         # Check dangerous permissions
         dangerous_perms = []
-        for member in ctx.guild.members:
+        for member in self.rt.perm_index.privileged_members(ctx.guild):
             if member.bot:
                 continue
             if member.guild_permissions.administrator:
@@ -868,7 +1247,7 @@ class AdvancedCommands(commands.Cog):
             )
         
         # Check bots
-        unverified_bots = [m for m in ctx.guild.members if m.bot and not m.public_flags.verified_bot]
+        unverified_bots = [m for m in self.rt.perm_index.bots(ctx.guild) if not m.public_flags.verified_bot]
         if unverified_bots:
             embed.add_field(
                 name=" Unverified Bots",
@@ -891,11 +1270,9 @@ class AdvancedCommands(commands.Cog):
     
     @commands.command(name='quarantine')
     @commands.has_permissions(administrator=True)
-    async def quarantine(self, ctx, user: discord.User, *, reason: str = "Suspicious activity"):
-        """Quarantine a suspicious user (alias for lockdown)"""
-        from bot import lockdown_user
-        
-        success, message = await lockdown_user(ctx.guild, user, f"Quarantined: {reason}")
+    async def quarantine(self, ctx, user: discord.User, duration: typing.Optional[Duration] = None, *, reason: str = "Suspicious activity"):
+        """Quarantine a suspicious user (alias for lockdown): !quarantine <@user> [duration] [reason]"""
+        success, message = await self.rt.lockdown_user(ctx.guild, user, f"Quarantined: {reason}", duration)
         
         if success:
             embed = discord.Embed(
@@ -905,44 +1282,123 @@ class AdvancedCommands(commands.Cog):
             )
             embed.add_field(name="Reason", value=reason, inline=False)
             embed.add_field(name="Status", value="User is isolated and invisible", inline=False)
+            embed.add_field(name="Duration", value=format_duration(duration) if duration else "Until unlocked", inline=False)
             await ctx.send(embed=embed)
         else:
             await ctx.send(f" Failed: {message}")
     
-    @commands.command(name='massban')
+    @commands.group(name='massban', invoke_without_command=True)
     @commands.has_permissions(administrator=True)
     async def massban(self, ctx, *user_ids: int):
         """Mass ban multiple users by ID"""
         if not user_ids:
-            await ctx.send("Usage: `!massban <user_id1> <user_id2> ...`")
+            await ctx.send("Usage: `!massban <user_id1> <user_id2> ...` or `!massban match name: <regex> [name: ...] [created: 3d] [joined: 1h] [noavatar: yes]`")
             return
         
         msg = await ctx.send(f" Mass banning {len(user_ids)} users...")
+        banned, failed = await self.rt.ban_users(ctx.guild, [discord.Object(id=uid) for uid in user_ids], f"Mass ban by {ctx.author}")
         
-        banned = 0
-        failed = 0
+        embed = discord.Embed(
+            title=" Mass Ban Complete",
+            color=discord.Color.red()
+        )
+        embed.add_field(name="Banned", value=str(len(banned)), inline=True)
+        embed.add_field(name="Failed", value=str(len(failed)), inline=True)
         
-        for user_id in user_ids:
-            try:
-                user = await self.bot.fetch_user(user_id)
-                await ctx.guild.ban(user, reason=f"Mass ban by {ctx.author}")
-                banned += 1
-            except:
-                failed += 1
+        await msg.edit(content=None, embed=embed)
+    
+    @massban.command(name='match')
+    @commands.has_permissions(administrator=True)
+    async def massban_match(self, ctx, *, flags: MemberMatch):
+        """Ban cached members matching name patterns and age filters, after a preview
+        Usage: !massban match name: <regex> [name: <regex> ...] [created: 3d] [joined: 1h] [noavatar: yes]
+        """
+        if not (flags.name or flags.created or flags.joined):
+            await ctx.send("Give at least one of name:, created: or joined: so the match cannot cover everyone")
+            return
+        try:
+            # All patterns in one alternation, so each name is searched once
+            pattern = re.compile('|'.join(f'(?:{p})' for p in flags.name), re.IGNORECASE) if flags.name else None
+        except re.error as e:
+            await ctx.send(f"Invalid pattern: {e}")
+            return
+        
+        await self.rt.ensure_chunked(ctx.guild)
+        config = await self.rt.get_config(ctx.guild.id)
+        now = discord.utils.utcnow()
+        created_after = now - flags.created if flags.created else None
+        joined_after = now - flags.joined if flags.joined else None
+        top_role = ctx.guild.me.top_role
+        
+        matches, protected = [], 0
+        for i, member in enumerate(ctx.guild.members):
+            if i and i % SCAN_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+            # Cheap attribute checks first; the regex only runs on what survives them
+            if member.bot:
+                continue
+            if created_after and member.created_at < created_after:
+                continue
+            if joined_after and (member.joined_at is None or member.joined_at < joined_after):
+                continue
+            if flags.noavatar and member.avatar is not None:
+                continue
+            if pattern and not (
+                pattern.search(member.name)
+                or (member.global_name and pattern.search(member.global_name))
+                or (member.nick and pattern.search(member.nick))
+            ):
+                continue
+            if member == ctx.author or member.top_role >= top_role or self.rt.is_exempt(ctx.guild, config, member.id):
+                protected += 1
+                continue
+            matches.append(member)
+        
+        if not matches:
+            await ctx.send(f"No members matched ({protected} protected members skipped)")
+            return
+        
+        embed = discord.Embed(
+            title=" Mass Ban Preview",
+            description=f"**{len(matches)}** members match. Type `confirm` within {MASSBAN_CONFIRM_TIMEOUT}s to ban them.",
+            color=discord.Color.orange()
+        )
+        sample = "\n".join(f"{m} ({m.id})" for m in matches[:10])
+        if len(matches) > 10:
+            sample += f"\n...and {len(matches) - 10} more"
+        embed.add_field(name="Matches", value=sample, inline=False)
+        if protected:
+            embed.add_field(name="Skipped", value=f"{protected} protected members (whitelisted, owner or above the bot)", inline=False)
+        await ctx.send(embed=embed)
+        
+        try:
+            await self.bot.wait_for(
+                'message',
+                check=lambda m: m.author == ctx.author and m.channel == ctx.channel and m.content.lower() == 'confirm',
+                timeout=MASSBAN_CONFIRM_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            await ctx.send("Mass ban cancelled")
+            return
+        
+        msg = await ctx.send(f" Mass banning {len(matches)} members...")
+        banned, failed = await self.rt.ban_users(ctx.guild, matches, f"Mass ban (match) by {ctx.author}")
         
         embed = discord.Embed(
             title=" Mass Ban Complete",
             color=discord.Color.red()
         )
-        embed.add_field(name="Banned", value=str(banned), inline=True)
-        embed.add_field(name="Failed", value=str(failed), inline=True)
-        
+        embed.add_field(name="Banned", value=str(len(banned)), inline=True)
+        embed.add_field(name="Failed", value=str(len(failed)), inline=True)
         await msg.edit(content=None, embed=embed)
+        # Logged without a user so the moderator is not counted as an offender
+        await self.rt.log_action(ctx.guild.id, 0, 'massban', f"{len(matches)} matched members", f"Mass ban by {ctx.author} ({ctx.author.id}): {len(banned)} banned", f"Patterns: {', '.join(flags.name) or 'none'}")
     
     @commands.command(name='masskick')
     @commands.has_permissions(administrator=True)
     async def masskick(self, ctx, role: discord.Role):
         """Kick all members with a specific role"""
+        await self.rt.ensure_chunked(ctx.guild)
         members_to_kick = [m for m in ctx.guild.members if role in m.roles]
         
         if not members_to_kick:
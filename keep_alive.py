@@ -10,6 +10,6 @@ def home():
 def run():
     app.run(host='0.0.0.0', port=10000)
 
-def keep_alive():
-    t = Thread(target=run)
+def keep_alive(daemon=False):
+    t = Thread(target=run, daemon=daemon)
     t.start()
@@ -0,0 +1,110 @@
+"""Run the bot as several worker processes, each owning a slice of the shards.
+
+Usage: python launcher.py --processes 4 [--shards 16] [--standby]
+
+Without --shards the recommended shard count is fetched from Discord. Every
+worker is a normal ``bot.py`` process running an AutoShardedBot over its own
+shard IDs; all of them share guardian.db in WAL mode. With --standby each
+cluster gets a second worker that waits on the cluster's lease in guardian.db
+and takes over the shards if the active worker dies.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from keep_alive import keep_alive
+from runtime import Runtime
+
+# Discord allows one IDENTIFY per 5 seconds per concurrency bucket
+IDENTIFY_INTERVAL = 5.5
+RESTART_DELAY = 10
+
+async def gateway_info(token):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            'https://discord.com/api/v10/gateway/bot',
+            headers={'Authorization': f'Bot {token}'}
+        ) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+    return data['shards'], data['session_start_limit']['max_concurrency']
+
+def shard_slices(shard_count, processes):
+    """Split shard IDs into contiguous slices, one per process"""
+    per_process, extra = divmod(shard_count, processes)
+    slices = []
+    start = 0
+    for i in range(processes):
+        size = per_process + (1 if i < extra else 0)
+        slices.append(list(range(start, start + size)))
+        start += size
+    return [s for s in slices if s]
+
+def spawn(cluster_id, shard_ids, shard_count, standby=False):
+    env = dict(
+        os.environ,
+        SHARD_COUNT=str(shard_count),
+        SHARD_IDS=','.join(map(str, shard_ids)),
+        CLUSTER_ID=str(cluster_id),
+        GUARDIAN_DB_READY='1',
+    )
+    if standby:
+        env['FAILOVER'] = '1'
+    print(f"[launcher] cluster {cluster_id}: shards {shard_ids[0]}-{shard_ids[-1]}")
+    return subprocess.Popen([sys.executable, 'bot.py'], env=env)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Guardian across several processes")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--shards', type=int, default=None)
+    parser.add_argument('--standby', action='store_true', help="Run a warm standby worker per cluster")
+    args = parser.parse_args()
+
+    max_concurrency = 1
+    shard_count = args.shards
+    if shard_count is None:
+        shard_count, max_concurrency = asyncio.run(gateway_info(os.getenv("TOKEN")))
+    # Never more processes than shards; extra processes would each need an extra IDENTIFY
+    processes = max(1, min(args.processes, shard_count))
+
+    # Run migrations once here so workers never race on ALTER TABLE
+    asyncio.run(Runtime(None).init_db())
+    keep_alive()
+
+    slices = shard_slices(shard_count, processes)
+    workers = {}
+    # Keyed by (cluster, copy); copy 1 only exists with --standby
+    copies = 2 if args.standby else 1
+    for cluster_id, shard_ids in enumerate(slices):
+        for copy in range(copies):
+            workers[(cluster_id, copy)] = spawn(cluster_id, shard_ids, shard_count, args.standby)
+        # Stagger start-up so identifies from different processes don't collide
+        time.sleep(IDENTIFY_INTERVAL * len(shard_ids) / max_concurrency)
+
+    def shutdown(signum, frame):
+        for proc in workers.values():
+            proc.terminate()
+        for proc in workers.values():
+            proc.wait()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while True:
+        time.sleep(1)
+        for (cluster_id, copy), proc in list(workers.items()):
+            if proc.poll() is not None:
+                print(f"[launcher] cluster {cluster_id} exited with {proc.returncode}, restarting in {RESTART_DELAY}s")
+                time.sleep(RESTART_DELAY)
+                # With a standby, the restarted worker comes back as the standby
+                workers[(cluster_id, copy)] = spawn(cluster_id, slices[cluster_id], shard_count, args.standby)
+
+if __name__ == "__main__":
+    main()
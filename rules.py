@@ -0,0 +1,116 @@
+"""Detection rules driven by Config.thresholds.
+
+Each rule maps an audit-log action to a threshold (count actions by one user
+within window seconds) and a response. A guild's thresholds are compiled into
+a dispatch table keyed by AuditLogAction, so evaluating an audit entry is one
+dict lookup plus a deque append. Adding a vector only takes a RULES entry and
+a default threshold in Config.
+"""
+import discord
+import time
+from bisect import bisect_right
+from collections import deque
+
+# name -> (audit action, embed title, default response)
+RULES = {
+    'channel_delete': (discord.AuditLogAction.channel_delete, "Channel Deleted", 'auto'),
+    'channel_create': (discord.AuditLogAction.channel_create, "Channel Created", 'alert'),
+    'role_delete': (discord.AuditLogAction.role_delete, "Role Deleted", 'auto'),
+    'member_kick': (discord.AuditLogAction.kick, "Member Kicked", 'auto'),
+    'member_ban': (discord.AuditLogAction.ban, "Member Banned", 'auto'),
+    'bot_join': (discord.AuditLogAction.bot_add, "Bot Added", 'kick_bot'),
+    'webhook_create': (discord.AuditLogAction.webhook_create, "Webhook Created", 'lockdown'),
+    'emoji_delete': (discord.AuditLogAction.emoji_delete, "Emoji Deleted", 'alert'),
+    'guild_update': (discord.AuditLogAction.guild_update, "Server Settings Changed", 'alert'),
+}
+
+# auto     - lockdown when the guild has auto-lockdown on, otherwise ban
+# lockdown - lockdown, falling back to a ban
+# ban      - ban the actor
+# alert    - only log and DM the alert users
+# kick_bot - kick the added bot if it is unverified (bot_join only)
+RESPONSES = ('auto', 'lockdown', 'ban', 'alert', 'kick_bot')
+
+# Hit counters are pruned once this many (guild, rule, user) keys exist
+PRUNE_AT = 10000
+
+class CompiledRule:
+    __slots__ = ('name', 'action', 'title', 'count', 'window', 'response')
+
+    def __init__(self, name, action, title, count, window, response):
+        self.name = name
+        self.action = action
+        self.title = title
+        self.count = count
+        self.window = window
+        self.response = response
+
+def compile_rules(thresholds):
+    """Dispatch table {AuditLogAction: CompiledRule} for the enabled rules"""
+    table = {}
+    for name, (action, title, default_response) in RULES.items():
+        settings = thresholds.get(name, {})
+        if not settings.get('enabled', True):
+            continue
+        response = settings.get('response', default_response)
+        if response not in RESPONSES:
+            response = default_response
+        table[action] = CompiledRule(
+            name, action, title,
+            max(1, int(settings.get('count', 1))),
+            int(settings.get('window', 0)),
+            response
+        )
+    return table
+
+def describe_target(entry):
+    """Readable name for an audit entry's target, which may already be deleted"""
+    target = entry.target
+    if isinstance(target, (discord.User, discord.Member)):
+        return str(target)
+    for source in (target, entry.before, entry.after):
+        name = getattr(source, 'name', None)
+        if name:
+            return name
+    return str(target.id) if target is not None else entry.guild.name
+
+class RuleEngine:
+    """Compiled rules per guild plus sliding-window hit counters"""
+
+    def __init__(self):
+        self.tables = {}
+        self.hits = {}
+
+    def rule_for(self, config, action):
+        """Rule for an audit action, recompiling when the guild's config was saved since"""
+        cached = self.tables.get(config.guild_id)
+        if cached is None or cached[0] != config.revision:
+            cached = (config.revision, compile_rules(config.thresholds))
+            self.tables[config.guild_id] = cached
+        return cached[1].get(action)
+
+    def hit(self, guild_id, rule, user_id, at=None):
+        """Count one action at monotonic time at (default now); True once the user
+        reaches the rule's count within the window ending there"""
+        now = time.monotonic()
+        if at is None:
+            at = now
+        key = (guild_id, rule.name, user_id)
+        times = self.hits.get(key)
+        if times is None:
+            if len(self.hits) >= PRUNE_AT:
+                self.prune(now)
+            times = self.hits[key] = deque()
+        if times and at < times[-1]:
+            # Replayed audit entries can arrive after newer live ones
+            times.insert(bisect_right(times, at), at)
+        else:
+            times.append(at)
+        cutoff = at - rule.window
+        while times and times[0] < cutoff:
+            times.popleft()
+        return bisect_right(times, at) >= rule.count
+
+    def prune(self, now, max_window=3600):
+        for key in [k for k, times in self.hits.items() if not times or times[-1] < now - max_window]:
+            del self.hits[key]
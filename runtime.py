@@ -0,0 +1,2653 @@
+"""Shared runtime state for the Guardian bot.
+
+bot.py builds a single Runtime around its commands.Bot and exposes it as
+``bot.runtime``. The cogs read it from there instead of importing bot.py,
+which runs as __main__ and would otherwise be loaded a second time.
+"""
+import discord
+import json
+import aiosqlite
+import aiohttp
+import base64
+import os
+import asyncio
+import csv
+import gzip
+import io
+import tempfile
+import time
+import heapq
+import math
+from array import array
+from bisect import bisect_left
+import logging
+import re
+import socket
+import struct
+from datetime import datetime, timedelta
+from collections import defaultdict, Counter, deque
+
+from rules import RuleEngine, CompiledRule, describe_target
+
+DB_PATH = 'guardian.db'
+# Seconds a connection waits on a lock held by another process sharing guardian.db
+DB_TIMEOUT = 30
+
+OWNER_ID = 728201873366056992
+DEFAULT_ALERT_USERS = {728201873366056992, 1063630678106853436}
+
+# Retention / maintenance settings
+DEFAULT_RETENTION_DAYS = 90
+MIN_BACKUPS_KEPT = 3
+MAINTENANCE_INTERVAL = 3600
+MAINTENANCE_BATCH = 500
+QUIET_PERIOD = 600
+
+# Role edits in flight at once during a bulk lockdown/unlock
+LOCKDOWN_CONCURRENCY = 5
+# Users unlocked per unlock_users call when timed lockdowns expire
+EXPIRY_BATCH = 50
+# Seconds before an expired lockdown whose unlock failed is tried again
+EXPIRY_RETRY_DELAY = 300
+# _apply_lock_role's error for a user the API says is not a member
+NOT_IN_SERVER = "User not in server"
+# Bans in flight at once during a mass ban
+BAN_CONCURRENCY = 5
+# Members given their roles back at once during a restore
+ROLE_RESTORE_CONCURRENCY = 5
+# Channel overwrite edits in flight at once during server lockdown/unlock
+CHANNEL_EDIT_CONCURRENCY = 5
+# Attempts (and seconds between them) to find a bot whose bot_add entry beat its member add
+BOT_ADD_FETCH_RETRIES = 3
+BOT_ADD_FETCH_DELAY = 1.0
+# Guilds whose audit log is caught up at once after a restart or reconnect
+AUDIT_CATCHUP_CONCURRENCY = 3
+# Oldest audit entries (seconds) replayed after a long outage
+AUDIT_CATCHUP_MAX_AGE = 6 * 3600
+# Failover lease: how long a lease lasts, how often the holder renews it (and a
+# standby polls), and how often a standby reloads its caches
+LEASE_TTL = 10
+LEASE_RENEW_INTERVAL = 3
+STANDBY_WARM_INTERVAL = 15
+# Also created by acquire_lease, since a standby takes the lease before running init_db
+LEASE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS lease (
+        cluster_id INTEGER PRIMARY KEY,
+        holder TEXT,
+        expires_at REAL,
+        acquired_at TEXT
+    )
+'''
+# Seconds between tracker checkpoints, and the oldest tracked action (seconds) kept on restore
+TRACKER_CHECKPOINT_INTERVAL = 15
+TRACKER_MAX_AGE = 3600
+# Seconds between passes that re-check the lockdown role's channel overwrites
+OVERWRITE_RECONCILE_INTERVAL = 1800
+
+# Log embeds per webhook execution, and how long a burst may accumulate first
+LOG_BATCH_SIZE = 10
+LOG_BATCH_DELAY = 1.0
+# Discord rejects a message whose embeds add up to more characters than this
+LOG_BATCH_CHARS = 6000
+# Attempts for a log batch that failed for a reason other than being rejected
+LOG_SEND_RETRIES = 3
+
+# Joins are attributed to invites by one diff per burst, taken this long after the first join
+INVITE_DIFF_DELAY = 1.0
+INVITE_LOAD_CONCURRENCY = 2
+
+# Seconds a finished containment response keeps absorbing repeat triggers for the same attacker
+RESPONSE_COOLDOWN = 60
+
+# REST priority classes, highest first; REST_CONCURRENCY slots are shared by the lower two
+CONTAINMENT, EVIDENCE, NOTIFY = 0, 1, 2
+PRIORITY_CLASSES = ('containment', 'evidence', 'notify')
+REST_CONCURRENCY = 4
+
+# Raid mode: guild verification floor and the @everyone permissions it strips
+RAID_MODE_VERIFICATION = discord.VerificationLevel.high
+RAID_MODE_DENY = discord.Permissions(
+    send_messages=True,
+    send_messages_in_threads=True,
+    create_public_threads=True,
+    create_private_threads=True,
+    add_reactions=True,
+    attach_files=True,
+    embed_links=True,
+    create_instant_invite=True,
+    connect=True
+)
+
+# Deny overwrite the lockdown role carries on every channel
+LOCKDOWN_OVERWRITE = discord.PermissionOverwrite(
+    view_channel=False,
+    send_messages=False,
+    read_messages=False,
+    connect=False,
+    speak=False,
+    add_reactions=False
+)
+
+def connect(db_path=DB_PATH):
+    return aiosqlite.connect(db_path, timeout=DB_TIMEOUT)
+
+class Config:
+    def __init__(self, guild_id, db_path=DB_PATH):
+        self.guild_id = guild_id
+        self.db_path = db_path
+        self.log_channel_id = None
+        self.lockdown_active = False
+        self.lockdown_role_id = None
+        self.auto_lockdown = False
+        self.locked_users = set()
+        self.retention_days = DEFAULT_RETENTION_DAYS
+        self.log_webhook_url = None
+        self.preempt_offenders = False
+        self.whitelist_users = set()
+        self.whitelist_bots = set()
+        self.alert_users = set()
+        self.thresholds = {
+            'channel_delete': {'count': 3, 'window': 60, 'enabled': True},
+            'role_delete': {'count': 3, 'window': 60, 'enabled': True},
+            'member_kick': {'count': 5, 'window': 60, 'enabled': True},
+            'member_ban': {'count': 5, 'window': 60, 'enabled': True},
+            'bot_join': {'enabled': True},
+            'permission_grant': {'count': 2, 'window': 300, 'enabled': True},
+            # Newer vectors only alert until a guild opts in with !guard rule
+            'channel_create': {'count': 5, 'window': 60, 'enabled': True, 'response': 'alert'},
+            'webhook_create': {'count': 3, 'window': 60, 'enabled': True},
+            'emoji_delete': {'count': 5, 'window': 60, 'enabled': True, 'response': 'alert'},
+            'guild_update': {'count': 3, 'window': 300, 'enabled': True, 'response': 'alert'},
+            'invite_spike': {'count': 10, 'window': 60, 'enabled': True},
+        }
+        # Bumped on every save so compiled rules know to rebuild
+        self.revision = 0
+    
+    @classmethod
+    async def load(cls, guild_id, db_path=DB_PATH):
+        async with connect(db_path) as db:
+            async with db.execute('SELECT * FROM configs WHERE guild_id = ?', (guild_id,)) as cursor:
+                row = await cursor.fetchone()
+        return cls.from_row(guild_id, row, db_path)
+
+    @classmethod
+    def from_row(cls, guild_id, row, db_path=DB_PATH):
+        """Build a config from a configs row (None for a guild with no row yet)"""
+        config = cls(guild_id, db_path)
+        if row:
+            config.log_channel_id = row[1]
+            config.lockdown_active = bool(row[2])
+            if row[3]:
+                config.whitelist_users = set(json.loads(row[3]))
+            if row[4]:
+                config.whitelist_bots = set(json.loads(row[4]))
+            if row[5]:
+                # Stored settings override the defaults key by key; vectors added later keep their defaults
+                for feature, settings in json.loads(row[5]).items():
+                    config.thresholds.setdefault(feature, {}).update(settings)
+            if row[6]:
+                config.alert_users = set(json.loads(row[6]))
+            else:
+                config.alert_users = DEFAULT_ALERT_USERS.copy()
+            # Load new lockdown fields
+            if len(row) > 7 and row[7]:
+                config.lockdown_role_id = row[7]
+            if len(row) > 8 and row[8]:
+                config.auto_lockdown = bool(row[8])
+            if len(row) > 9 and row[9]:
+                config.locked_users = set(json.loads(row[9]))
+            if len(row) > 10 and row[10] is not None:
+                config.retention_days = row[10]
+            if len(row) > 11 and row[11]:
+                config.log_webhook_url = row[11]
+            if len(row) > 12 and row[12]:
+                config.preempt_offenders = bool(row[12])
+        else:
+            config.alert_users = DEFAULT_ALERT_USERS.copy()
+        
+        if not config.alert_users:
+            config.alert_users = DEFAULT_ALERT_USERS.copy()
+        
+        return config
+    
+    async def save(self):
+        self.revision += 1
+        async with connect(self.db_path) as db:
+            await db.execute('''
+                INSERT OR REPLACE INTO configs 
+                (guild_id, log_channel_id, lockdown_active, whitelist_users, whitelist_bots, thresholds, alert_users, lockdown_role_id, auto_lockdown, locked_users, retention_days, log_webhook_url, preempt_offenders)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                self.guild_id,
+                self.log_channel_id,
+                int(self.lockdown_active),
+                json.dumps(list(self.whitelist_users)),
+                json.dumps(list(self.whitelist_bots)),
+                json.dumps(self.thresholds),
+                json.dumps(list(self.alert_users)),
+                self.lockdown_role_id,
+                int(self.auto_lockdown),
+                json.dumps(list(self.locked_users)),
+                self.retention_days,
+                self.log_webhook_url,
+                int(self.preempt_offenders)
+            ))
+            await db.commit()
+
+# Permissions that make a member worth listing in scan / nuke checks
+PRIVILEGED_MASK = discord.Permissions(administrator=True, manage_guild=True).value
+
+class PermissionIndex:
+    """Per-guild index of privileged members and bots.
+
+    Built once from the member cache, then kept current from member and role
+    events so scans only touch privileged members instead of the whole guild.
+    """
+
+    def __init__(self):
+        self.guilds = {}
+
+    def build(self, guild):
+        roles = {r.id for r in guild.roles if r.permissions.value & PRIVILEGED_MASK}
+        members = {}
+        bots = set()
+        for member in guild.members:
+            if member.bot:
+                bots.add(member.id)
+            held = {r.id for r in member.roles if r.id in roles}
+            if held:
+                members[member.id] = held
+
+        entry = {
+            'roles': roles,
+            'members': members,
+            'bots': bots,
+            'complete': guild.chunked,
+        }
+        self.guilds[guild.id] = entry
+        return entry
+
+    def get(self, guild):
+        entry = self.guilds.get(guild.id)
+        if entry is None or (not entry['complete'] and guild.chunked):
+            entry = self.build(guild)
+        return entry
+
+    def privileged_members(self, guild):
+        """Members holding a privileged role, plus the owner"""
+        entry = self.get(guild)
+        if guild.default_role.id in entry['roles']:
+            # @everyone itself is privileged, so every member is
+            return list(guild.members)
+
+        ids = set(entry['members'])
+        if guild.owner_id:
+            ids.add(guild.owner_id)
+        return [m for m in map(guild.get_member, ids) if m]
+
+    def bots(self, guild):
+        entry = self.get(guild)
+        return [m for m in map(guild.get_member, entry['bots']) if m]
+
+    def update_member(self, member):
+        entry = self.guilds.get(member.guild.id)
+        if entry is None:
+            return
+        if member.bot:
+            entry['bots'].add(member.id)
+        held = {r.id for r in member.roles if r.id in entry['roles']}
+        if held:
+            entry['members'][member.id] = held
+        else:
+            entry['members'].pop(member.id, None)
+
+    def remove_member(self, guild_id, member_id):
+        entry = self.guilds.get(guild_id)
+        if entry is None:
+            return
+        entry['members'].pop(member_id, None)
+        entry['bots'].discard(member_id)
+
+    def update_role(self, role):
+        entry = self.guilds.get(role.guild.id)
+        if entry is None:
+            return
+        privileged = bool(role.permissions.value & PRIVILEGED_MASK)
+        if privileged == (role.id in entry['roles']):
+            return
+
+        if privileged:
+            entry['roles'].add(role.id)
+            # Rare event; role.members walks the member cache once
+            for member in role.members:
+                entry['members'].setdefault(member.id, set()).add(role.id)
+        else:
+            self.remove_role(role.guild.id, role.id)
+
+    def remove_role(self, guild_id, role_id):
+        entry = self.guilds.get(guild_id)
+        if entry is None or role_id not in entry['roles']:
+            return
+        entry['roles'].discard(role_id)
+        for member_id in [mid for mid, held in entry['members'].items() if role_id in held]:
+            held = entry['members'][member_id]
+            held.discard(role_id)
+            if not held:
+                del entry['members'][member_id]
+
+class RoleMembers:
+    """Who holds each role, per guild, as sorted arrays of member ids.
+
+    Built from the member cache the first time a guild is backed up, then kept
+    current from member updates, so backups serialise each role's array as-is
+    (8 bytes per assignment) instead of walking every member's roles.
+    """
+
+    def __init__(self):
+        self.guilds = {}
+
+    def build(self, guild):
+        held = defaultdict(list)
+        for member in guild.members:
+            for role in member.roles:
+                held[role.id].append(member.id)
+        entry = {
+            'roles': {role_id: array('q', sorted(ids)) for role_id, ids in held.items()},
+            'complete': guild.chunked,
+        }
+        self.guilds[guild.id] = entry
+        return entry
+
+    def get(self, guild):
+        entry = self.guilds.get(guild.id)
+        if entry is None or (not entry['complete'] and guild.chunked):
+            entry = self.build(guild)
+        return entry
+
+    def update(self, before, after):
+        entry = self.guilds.get(after.guild.id)
+        if entry is None:
+            return
+        old = {r.id for r in before.roles}
+        new = {r.id for r in after.roles}
+        for role_id in new - old:
+            ids = entry['roles'].setdefault(role_id, array('q'))
+            i = bisect_left(ids, after.id)
+            if i == len(ids) or ids[i] != after.id:
+                ids.insert(i, after.id)
+        for role_id in old - new:
+            self._discard(entry, role_id, after.id)
+
+    def remove_member(self, member):
+        entry = self.guilds.get(member.guild.id)
+        if entry is None:
+            return
+        for role in member.roles:
+            self._discard(entry, role.id, member.id)
+
+    def remove_role(self, guild_id, role_id):
+        entry = self.guilds.get(guild_id)
+        if entry is not None:
+            entry['roles'].pop(role_id, None)
+
+    def _discard(self, entry, role_id, member_id):
+        ids = entry['roles'].get(role_id)
+        if ids is None:
+            return
+        i = bisect_left(ids, member_id)
+        if i < len(ids) and ids[i] == member_id:
+            del ids[i]
+
+    def snapshot(self, guild):
+        """{role id: base64 of the member id array} for roles a restore can reassign"""
+        entry = self.get(guild)
+        skip = {r.id for r in guild.roles if r.is_default() or r.managed}
+        return {
+            str(role_id): base64.b64encode(ids.tobytes()).decode()
+            for role_id, ids in entry['roles'].items()
+            if ids and role_id not in skip
+        }
+
+def load_role_members(data):
+    """Inverse of RoleMembers.snapshot: {role id: array of member ids}"""
+    return {int(role_id): array('q', base64.b64decode(blob)) for role_id, blob in data.items()}
+
+# Permissions whose grant is treated as a privilege escalation. Moderator
+# permissions (kick, ban, manage channels) are left out: granting them is routine
+DANGEROUS_MASK = discord.Permissions(
+    administrator=True,
+    manage_guild=True,
+    manage_roles=True,
+).value
+
+class ResponseFlight:
+    """One containment response in progress (or cooling down) for an attacker"""
+
+    def __init__(self, task, evidence=None):
+        self.task = task
+        self.started = time.monotonic()
+        self.finished = None
+        self.evidence = [evidence] if evidence is not None else []
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.finished = time.monotonic()
+
+class OffenderIndex:
+    """User ids banned or locked down as raiders in any protected guild.
+
+    Kept as one sorted array of 64-bit ints (8 bytes per id), so a join check
+    is a binary search with no database round trip.
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.loaded_until = ''
+
+    def __contains__(self, user_id):
+        i = bisect_left(self.ids, user_id)
+        return i < len(self.ids) and self.ids[i] == user_id
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, user_id):
+        i = bisect_left(self.ids, user_id)
+        if i == len(self.ids) or self.ids[i] != user_id:
+            self.ids.insert(i, user_id)
+
+    def extend(self, user_ids):
+        self.ids = array('q', sorted(set(self.ids).union(user_ids)))
+
+# Tracker checkpoint layout: header, one record per tracked key, then the audit
+# entries already counted but not yet covered by a cursor, all little-endian
+#   header: magic, saved at (epoch), record count, counted entry count
+#   record: guild id, kind, name length, key length, name, key, time count, times (epoch doubles)
+#   counted entries: (guild id, entry id) int64 pairs
+CHECKPOINT_MAGIC = b'GTC2'
+CHECKPOINT_HEADER = struct.Struct('<4sdII')
+CHECKPOINT_RECORD = struct.Struct('<qBHH')
+CHECKPOINT_COUNT = struct.Struct('<I')
+RULE_HITS, ACTION_TRACKER = 0, 1
+
+def pack_trackers(records, saved_at, counted=()):
+    """records: iterable of (guild id, kind, name, key, [epoch times]);
+    counted: iterable of (guild id, audit entry id) -> bytes"""
+    parts = []
+    count = 0
+    for guild_id, kind, name, key, times in records:
+        if not times:
+            continue
+        name, key = name.encode(), str(key).encode()
+        parts.append(CHECKPOINT_RECORD.pack(guild_id, kind, len(name), len(key)))
+        parts.append(name + key)
+        parts.append(CHECKPOINT_COUNT.pack(len(times)))
+        parts.append(array('d', times).tobytes())
+        count += 1
+    pairs = array('q', [n for pair in counted for n in pair])
+    return CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, saved_at, count, len(pairs) // 2) + b''.join(parts) + pairs.tobytes()
+
+def unpack_trackers(data):
+    """Inverse of pack_trackers: (saved at, [(guild id, kind, name, key, times)], [(guild id, entry id)])"""
+    magic, saved_at, count, counted_count = CHECKPOINT_HEADER.unpack_from(data)
+    if magic != CHECKPOINT_MAGIC:
+        raise ValueError("Not a tracker checkpoint")
+    offset = CHECKPOINT_HEADER.size
+    records = []
+    for _ in range(count):
+        guild_id, kind, name_len, key_len = CHECKPOINT_RECORD.unpack_from(data, offset)
+        offset += CHECKPOINT_RECORD.size
+        name = data[offset:offset + name_len].decode()
+        key = data[offset + name_len:offset + name_len + key_len].decode()
+        offset += name_len + key_len
+        n, = CHECKPOINT_COUNT.unpack_from(data, offset)
+        offset += CHECKPOINT_COUNT.size
+        times = array('d')
+        times.frombytes(data[offset:offset + 8 * n])
+        offset += 8 * n
+        # Most keys are user ids; velocity keys such as channel:<id> stay strings
+        records.append((guild_id, kind, name, int(key) if key.isdigit() else key, times))
+    pairs = array('q')
+    pairs.frombytes(data[offset:offset + 16 * counted_count])
+    return saved_at, records, list(zip(pairs[::2], pairs[1::2]))
+
+class InviteCache:
+    """Invite use counts per guild, and who joined through which invite.
+
+    Counts are filled once per guild and then kept current from invite
+    create/delete events and the coalesced diffs taken after joins.
+    """
+
+    def __init__(self):
+        self.uses = {}
+        self.joins = defaultdict(deque)
+
+    def snapshot(self, guild_id, invites):
+        self.uses[guild_id] = {invite.code: invite.uses or 0 for invite in invites}
+
+    def add(self, invite):
+        if invite.guild and invite.guild.id in self.uses:
+            self.uses[invite.guild.id][invite.code] = invite.uses or 0
+
+    def remove(self, invite):
+        if invite.guild and invite.guild.id in self.uses:
+            self.uses[invite.guild.id].pop(invite.code, None)
+
+    def diff(self, guild_id, invites):
+        """{code: new uses} since the last snapshot, which is replaced by this one"""
+        old = self.uses.get(guild_id, {})
+        increases = {}
+        for invite in invites:
+            delta = (invite.uses or 0) - old.get(invite.code, 0)
+            if delta > 0:
+                increases[invite.code] = delta
+        self.snapshot(guild_id, invites)
+        return increases
+
+    def record_joins(self, guild_id, code, member_ids, window):
+        """Remember who joined through an invite and prune anything older than window"""
+        now = time.monotonic()
+        joins = self.joins[(guild_id, code)]
+        for member_id in member_ids:
+            joins.append((now, member_id))
+        while joins and joins[0][0] < now - window:
+            joins.popleft()
+        return [member_id for _, member_id in joins]
+
+def take_log_batch(queue):
+    """Pop the longest prefix of queue that fits in one message, by count and by length"""
+    size = chars = 0
+    for embed in queue[:LOG_BATCH_SIZE]:
+        if size and chars + len(embed) > LOG_BATCH_CHARS:
+            break
+        chars += len(embed)
+        size += 1
+    batch = queue[:size]
+    del queue[:size]
+    return batch
+
+class WebhookLogger:
+    """Delivers log embeds through the log channel's webhook.
+
+    Webhook executions have their own rate limits, so log traffic no longer
+    competes with bans and role edits. Embeds queue per webhook and go out up
+    to LOG_BATCH_SIZE at a time over one persistent HTTP session.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.queues = {}
+        self.tasks = {}
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    def enqueue(self, url, embed, on_failure):
+        self.queues.setdefault(url, []).append(embed)
+        task = self.tasks.get(url)
+        if task is None or task.done():
+            self.tasks[url] = asyncio.ensure_future(self._drain(url, on_failure))
+
+    async def _drain(self, url, on_failure):
+        # Give a burst a moment to accumulate into full batches
+        await asyncio.sleep(LOG_BATCH_DELAY)
+        webhook = discord.Webhook.from_url(url, session=self.get_session())
+        attempts = 0
+        while self.queues.get(url):
+            batch = take_log_batch(self.queues[url])
+            try:
+                await webhook.send(embeds=batch, username="Guardian Logs")
+                attempts = 0
+                continue
+            except (discord.NotFound, discord.Forbidden):
+                # Webhook was deleted or its channel locked: hand everything back
+                await on_failure(batch + self.queues.pop(url, []))
+                return
+            except discord.HTTPException as e:
+                if e.status == 400:
+                    if len(batch) == 1:
+                        print(f"Webhook log delivery failed: {e}")
+                    else:
+                        # Rejected; resend one by one so only the bad embed is lost
+                        for embed in batch:
+                            try:
+                                await webhook.send(embed=embed, username="Guardian Logs")
+                            except Exception as err:
+                                print(f"Webhook log delivery failed: {err}")
+                    continue
+                error = e
+            except Exception as e:
+                error = e
+
+            # Server error or connection trouble: put the batch back and try again shortly
+            if attempts < LOG_SEND_RETRIES:
+                attempts += 1
+                self.queues[url][:0] = batch
+                await asyncio.sleep(attempts)
+            else:
+                print(f"Webhook log delivery failed: {error}")
+                attempts = 0
+        self.queues.pop(url, None)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+class RateLimitTracker(logging.Handler):
+    """Counts the 429s discord.http logs, per route with snowflakes stripped"""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.buckets = Counter()
+        self.global_hits = 0
+        self.last_hit = None
+
+    def emit(self, record):
+        if not isinstance(record.msg, str):
+            return
+        if record.msg.startswith('Global rate limit'):
+            self.global_hits += 1
+            self.last_hit = datetime.utcnow()
+        elif record.msg.startswith('We are being rate limited') and len(record.args) >= 2:
+            method, url = record.args[0], str(record.args[1])
+            route = re.sub(r'^v\d+', '', re.sub(r'\d{15,21}', ':id', url.split('/api/', 1)[-1]))
+            self.buckets[f"{method} {route}"] += 1
+            self.last_hit = datetime.utcnow()
+
+class RestScheduler:
+    """Orders outgoing Discord calls by priority class.
+
+    Containment (bans, lockdowns, reverts) always runs straight away. Evidence
+    (audit-log reads) and notifications (log embeds, DMs) share a small pool of
+    slots, and a freed slot goes to the highest-priority waiter first.
+    """
+
+    def __init__(self, concurrency=REST_CONCURRENCY):
+        self.concurrency = concurrency
+        self.active = 0
+        self.waiters = []
+        self.seq = 0
+        self.completed = [0] * len(PRIORITY_CLASSES)
+        self.max_wait = [0.0] * len(PRIORITY_CLASSES)
+        self.ratelimits = RateLimitTracker()
+
+    def slot(self, priority):
+        """`async with rest.slot(NOTIFY):` around a single API call"""
+        return RestSlot(self, priority)
+
+    async def acquire(self, priority):
+        start = time.monotonic()
+        if priority == CONTAINMENT or (self.active < self.concurrency and not self.waiters):
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.seq += 1
+            heapq.heappush(self.waiters, (priority, self.seq, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Cancelled after being handed a slot: pass it on
+                if future.done() and not future.cancelled():
+                    self.release(priority)
+                raise
+        self.max_wait[priority] = max(self.max_wait[priority], time.monotonic() - start)
+
+    def release(self, priority):
+        self.active -= 1
+        self.completed[priority] += 1
+        while self.waiters and self.active < self.concurrency:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def queued(self):
+        counts = Counter(priority for priority, _, future in self.waiters if not future.done())
+        return [counts[p] for p in range(len(PRIORITY_CLASSES))]
+
+    def budget(self, http):
+        """(known buckets, buckets currently exhausted) from discord.py's rate limit state"""
+        buckets = getattr(http, '_buckets', None) or {}
+        now = asyncio.get_running_loop().time()
+        exhausted = sum(1 for r in buckets.values() if r.remaining == 0 and r.expires and r.expires > now)
+        return len(buckets), exhausted
+
+class RestSlot:
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.priority)
+
+    async def __aexit__(self, *exc):
+        self.scheduler.release(self.priority)
+        return False
+
+class AuditLogCache:
+    """Recent audit-log entries per (guild, action), shared between handlers.
+
+    Concurrent lookups for the same guild and action share one fetch, and a
+    fetched page is reused for a few seconds before it is considered stale.
+    """
+
+    def __init__(self, ttl=3.0, limit=25, max_age=60, rest=None):
+        self.ttl = ttl
+        self.limit = limit
+        self.max_age = max_age
+        self.rest = rest or RestScheduler()
+        self.entries = {}
+        self.pending = {}
+        # Entries delivered by on_audit_log_entry_create, newest first
+        self.pushed = defaultdict(lambda: deque(maxlen=self.limit))
+
+    async def fetch(self, guild, action):
+        key = (guild.id, action)
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(guild, action))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, guild, action):
+        async with self.rest.slot(EVIDENCE):
+            entries = [entry async for entry in guild.audit_logs(limit=self.limit, action=action)]
+        self.entries[(guild.id, action)] = (time.monotonic(), entries)
+        return entries
+
+    def record(self, entry):
+        """Keep an entry pushed over the gateway so find() can skip the REST fetch"""
+        self.pushed[(entry.guild.id, entry.action)].appendleft(entry)
+
+    def match(self, entries, target_id):
+        cutoff = discord.utils.utcnow() - timedelta(seconds=self.max_age)
+        for entry in entries:
+            if entry.target is not None and entry.target.id == target_id and entry.created_at >= cutoff:
+                return entry
+        return None
+
+    async def find(self, guild, action, target_id, retries=2):
+        """Newest recent entry for target_id, waiting briefly for it to appear"""
+        cached = self.entries.get((guild.id, action))
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            entry = self.match(cached[1], target_id)
+            if entry:
+                return entry
+
+        for attempt in range(retries + 1):
+            entry = self.match(self.pushed.get((guild.id, action), ()), target_id)
+            if entry:
+                return entry
+            try:
+                entries = await self.fetch(guild, action)
+            except discord.HTTPException:
+                return None
+            entry = self.match(entries, target_id)
+            if entry or attempt == retries:
+                return entry
+            # Audit entries can lag the gateway event slightly
+            await asyncio.sleep(1)
+
+
+# Columns streamed by !guard export, per table
+EXPORT_TABLES = {
+    'evidence': ('id', 'guild_id', 'user_id', 'action_type', 'timestamp', 'data'),
+    'action_log': ('id', 'guild_id', 'user_id', 'action_type', 'target', 'timestamp', 'bot_action', 'details'),
+}
+EXPORT_FLUSH_BYTES = 256 * 1024
+
+def has_control_perms(guild, member):
+    return member.guild_permissions.administrator or member.guild_permissions.ban_members
+
+
+class ProcessMetrics:
+    """Counters for one bot process, written to process_metrics for !guard shards"""
+
+    def __init__(self, cluster_id):
+        self.cluster_id = cluster_id
+        self.started = time.time()
+        self.events = 0
+        self.loop_lag = 0.0
+        self._last_events = 0
+        self._last_sample = time.monotonic()
+
+    async def probe_loop_lag(self, interval=1.0):
+        """Track how late the event loop wakes up; long handlers show up here first"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = loop.time() - start - interval
+            # Decay slowly so a single spike stays visible for a while
+            self.loop_lag = max(lag, self.loop_lag * 0.9)
+
+    def rss_kb(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        except (OSError, ValueError):
+            return 0
+
+    def snapshot(self, bot):
+        now = time.monotonic()
+        elapsed = max(now - self._last_sample, 1e-6)
+        rate = (self.events - self._last_events) * 60 / elapsed
+        self._last_events = self.events
+        self._last_sample = now
+
+        # AutoShardedBot exposes its shards; a plain Bot is a single shard
+        if getattr(bot, 'shards', None):
+            shard_ids = sorted(bot.shards)
+        else:
+            shard_ids = getattr(bot, 'shard_ids', None) or [bot.shard_id or 0]
+        return (
+            self.cluster_id,
+            os.getpid(),
+            ','.join(str(i) for i in shard_ids),
+            len(bot.guilds),
+            -1 if math.isnan(bot.latency) else round(bot.latency * 1000),
+            self.events,
+            round(rate),
+            round(self.loop_lag * 1000),
+            self.rss_kb(),
+            round(time.time() - self.started),
+            datetime.utcnow().isoformat(),
+        )
+
+class Runtime:
+    """Process-wide state shared by the event handlers and the cogs"""
+
+    def __init__(self, bot, db_path=DB_PATH, cluster_id=0):
+        self.bot = bot
+        self.db_path = db_path
+        self.cluster_id = cluster_id
+        self.metrics = ProcessMetrics(cluster_id)
+        self.configs = {}
+        self.action_tracker = defaultdict(lambda: defaultdict(list))
+        self.perm_index = PermissionIndex()
+        self.role_members = RoleMembers()
+        self.rest = RestScheduler()
+        logging.getLogger('discord.http').addHandler(self.rest.ratelimits)
+        self.audit_cache = AuditLogCache(rest=self.rest)
+        self.rules = RuleEngine()
+        self.log_webhooks = WebhookLogger()
+        self.offenders = OffenderIndex()
+        # Webhook ids seen per channel, and (time, creator) of the recently created ones
+        self.channel_webhooks = {}
+        self.new_webhooks = defaultdict(deque)
+        self.audit_cursors = {}
+        self.dirty_audit_cursors = set()
+        self.audit_cursors_loaded = False
+        # True from startup or a disconnect until the audit log has been caught up
+        self.audit_gap = True
+        self.live_audit_ids = defaultdict(set)
+        self.audit_catch_up_task = None
+        # Bumped on every disconnect, so a catch-up can tell the connection dropped while it ran
+        self.audit_disconnects = 0
+        self.audit_catch_up_again = False
+        self.lease_holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_expires = 0
+        self.lease_table_ready = False
+        self.invites = InviteCache()
+        self.join_queues = defaultdict(list)
+        self.join_tasks = {}
+        # (guild_id, user_id) -> ResponseFlight, see respond_once
+        self.responses = {}
+
+        # Monotonic time of the last logged event, used to find quiet periods for maintenance
+        self.last_activity = 0.0
+        self.maintenance_stats = {}
+
+        # Lazy member chunking (see MEMBER_CACHE_PROFILE in bot.py)
+        self.chunk_queue = []
+        self.chunk_tasks = {}
+        self.chunk_wakeup = asyncio.Event()
+
+        # Timed lockdowns: (guild_id, user_id) -> expiry, plus a heap of (expiry, guild_id, user_id)
+        self.lock_expiries = {}
+        self.expiry_heap = []
+        self.expiry_wakeup = asyncio.Event()
+
+    def db(self):
+        """Open a connection to the bot database, for use with `async with`"""
+        return connect(self.db_path)
+
+    async def get_config(self, guild_id):
+        if guild_id not in self.configs:
+            self.configs[guild_id] = await Config.load(guild_id, self.db_path)
+        return self.configs[guild_id]
+
+    async def init_db(self):
+        async with self.db() as db:
+            # WAL lets several bot processes read while one writes
+            await db.execute('PRAGMA journal_mode=WAL')
+
+            # Create base tables
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS configs (
+                    guild_id INTEGER PRIMARY KEY,
+                    log_channel_id INTEGER,
+                    lockdown_active INTEGER DEFAULT 0,
+                    whitelist_users TEXT,
+                    whitelist_bots TEXT,
+                    thresholds TEXT,
+                    alert_users TEXT
+                )
+            ''')
+        
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS evidence (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    guild_id INTEGER,
+                    user_id INTEGER,
+                    action_type TEXT,
+                    timestamp TEXT,
+                    data TEXT
+                )
+            ''')
+        
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS backups (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    guild_id INTEGER,
+                    timestamp TEXT,
+                    data TEXT
+                )
+            ''')
+        
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS action_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    guild_id INTEGER,
+                    user_id INTEGER,
+                    action_type TEXT,
+                    target TEXT,
+                    timestamp TEXT,
+                    bot_action TEXT,
+                    details TEXT
+                )
+            ''')
+        
+            # Daily rollups of rows removed by the retention job
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS evidence_daily (
+                    guild_id INTEGER,
+                    day TEXT,
+                    action_type TEXT,
+                    count INTEGER DEFAULT 0,
+                    mass_count INTEGER DEFAULT 0,
+                    PRIMARY KEY (guild_id, day, action_type)
+                )
+            ''')
+
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS action_log_daily (
+                    guild_id INTEGER,
+                    day TEXT,
+                    action_type TEXT,
+                    bot_action TEXT,
+                    count INTEGER DEFAULT 0,
+                    PRIMARY KEY (guild_id, day, action_type, bot_action)
+                )
+            ''')
+
+            # Rollups maintained by log_action for !guard stats
+            async with db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'action_stats_hourly'") as cursor:
+                backfill_stats = await cursor.fetchone() is None
+
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS action_stats_hourly (
+                    guild_id INTEGER,
+                    hour TEXT,
+                    action_type TEXT,
+                    bot_action TEXT,
+                    count INTEGER DEFAULT 0,
+                    raid_count INTEGER DEFAULT 0,
+                    response_ms INTEGER DEFAULT 0,
+                    response_count INTEGER DEFAULT 0,
+                    PRIMARY KEY (guild_id, hour, action_type, bot_action)
+                )
+            ''')
+
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS action_stats_monthly (
+                    guild_id INTEGER,
+                    month TEXT,
+                    action_type TEXT,
+                    count INTEGER DEFAULT 0,
+                    raid_count INTEGER DEFAULT 0,
+                    response_ms INTEGER DEFAULT 0,
+                    response_count INTEGER DEFAULT 0,
+                    PRIMARY KEY (guild_id, month, action_type)
+                )
+            ''')
+
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS offender_stats_monthly (
+                    guild_id INTEGER,
+                    month TEXT,
+                    user_id INTEGER,
+                    count INTEGER DEFAULT 0,
+                    raid_count INTEGER DEFAULT 0,
+                    PRIMARY KEY (guild_id, month, user_id)
+                )
+            ''')
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_offender_stats_rank ON offender_stats_monthly (guild_id, month, raid_count, count)')
+
+            if backfill_stats:
+                # One-off seed from the existing action_log; log_action keeps them current afterwards
+                raid = "CASE WHEN details = 'Mass: True' OR (action_type = 'bot_join' AND details = 'Verified: False') THEN 1 ELSE 0 END"
+                await db.execute(f'''
+                    INSERT INTO action_stats_hourly (guild_id, hour, action_type, bot_action, count, raid_count)
+                    SELECT guild_id, substr(timestamp, 1, 13), action_type, bot_action, COUNT(*), SUM({raid})
+                    FROM action_log GROUP BY 1, 2, 3, 4
+                ''')
+                await db.execute(f'''
+                    INSERT INTO action_stats_monthly (guild_id, month, action_type, count, raid_count)
+                    SELECT guild_id, substr(timestamp, 1, 7), action_type, COUNT(*), SUM({raid})
+                    FROM action_log GROUP BY 1, 2, 3
+                ''')
+                await db.execute(f'''
+                    INSERT INTO offender_stats_monthly (guild_id, month, user_id, count, raid_count)
+                    SELECT guild_id, substr(timestamp, 1, 7), user_id, COUNT(*), SUM({raid})
+                    FROM action_log GROUP BY 1, 2, 3
+                ''')
+
+            # Cross-guild offender index: anyone banned or locked down as a raider
+            async with db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'offenders'") as cursor:
+                backfill_offenders = await cursor.fetchone() is None
+
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS offenders (
+                    user_id INTEGER PRIMARY KEY,
+                    guild_id INTEGER,
+                    bot_action TEXT,
+                    added_at TEXT
+                )
+            ''')
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_offenders_added ON offenders (added_at)')
+
+            if backfill_offenders:
+                await db.execute('''
+                    INSERT OR IGNORE INTO offenders (user_id, guild_id, bot_action, added_at)
+                    SELECT user_id, guild_id, bot_action, MIN(timestamp) FROM action_log
+                    WHERE bot_action GLOB '*BANNED USER*' OR bot_action GLOB '*LOCKED DOWN*'
+                    GROUP BY user_id
+                ''')
+
+            # Newest audit-log entry handled per guild, so missed entries can be replayed
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS audit_cursor (
+                    guild_id INTEGER PRIMARY KEY,
+                    entry_id INTEGER,
+                    updated_at TEXT
+                )
+            ''')
+
+            # Which process runs each cluster's gateway session when a standby is configured
+            await db.execute(LEASE_TABLE)
+
+            # Sliding-window tracker state per bot process, packed by pack_trackers
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS tracker_checkpoint (
+                    cluster_id INTEGER PRIMARY KEY,
+                    data BLOB,
+                    saved_at TEXT
+                )
+            ''')
+
+            # One row per bot process, refreshed by its metrics loop
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS process_metrics (
+                    cluster_id INTEGER PRIMARY KEY,
+                    pid INTEGER,
+                    shard_ids TEXT,
+                    guilds INTEGER,
+                    latency_ms INTEGER,
+                    events INTEGER,
+                    events_per_min INTEGER,
+                    loop_lag_ms INTEGER,
+                    rss_kb INTEGER,
+                    uptime INTEGER,
+                    updated_at TEXT
+                )
+            ''')
+
+            # Guild settings captured when raid mode was switched on
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS raid_mode (
+                    guild_id INTEGER PRIMARY KEY,
+                    snapshot TEXT,
+                    started_at TEXT
+                )
+            ''')
+
+            # @everyone overwrites replaced by !guard lockdown, as {channel_id: [allow, deny] or null}
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS lockdown_snapshot (
+                    guild_id INTEGER PRIMARY KEY,
+                    data TEXT,
+                    created_at TEXT
+                )
+            ''')
+
+            # Pending unlocks for timed lockdowns and quarantines
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS lock_expiry (
+                    guild_id INTEGER,
+                    user_id INTEGER,
+                    expires_at TEXT,
+                    PRIMARY KEY (guild_id, user_id)
+                )
+            ''')
+
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_evidence_guild_time ON evidence (guild_id, timestamp)')
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_action_log_guild_time ON action_log (guild_id, timestamp)')
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_backups_guild ON backups (guild_id, id)')
+
+            # Atomic migration with verification
+            async with db.execute("PRAGMA table_info(configs)") as cursor:
+                columns = await cursor.fetchall()
+                existing_columns = {col[1] for col in columns}
+        
+            # Define required new columns
+            migrations_needed = []
+            if 'lockdown_role_id' not in existing_columns:
+                migrations_needed.append(('lockdown_role_id', 'INTEGER'))
+            if 'auto_lockdown' not in existing_columns:
+                migrations_needed.append(('auto_lockdown', 'INTEGER DEFAULT 0'))
+            if 'locked_users' not in existing_columns:
+                migrations_needed.append(('locked_users', 'TEXT'))
+            if 'retention_days' not in existing_columns:
+                migrations_needed.append(('retention_days', f'INTEGER DEFAULT {DEFAULT_RETENTION_DAYS}'))
+            if 'log_webhook_url' not in existing_columns:
+                migrations_needed.append(('log_webhook_url', 'TEXT'))
+            if 'preempt_offenders' not in existing_columns:
+                migrations_needed.append(('preempt_offenders', 'INTEGER DEFAULT 0'))
+        
+            # Execute migrations in transaction
+            if migrations_needed:
+                try:
+                    for col_name, col_type in migrations_needed:
+                        await db.execute(f'ALTER TABLE configs ADD COLUMN {col_name} {col_type}')
+                        print(f"✅ Migration: Added column {col_name} to configs")
+                
+                    # Verify migration succeeded
+                    async with db.execute("PRAGMA table_info(configs)") as cursor:
+                        columns_after = await cursor.fetchall()
+                        final_columns = {col[1] for col in columns_after}
+                
+                    required_columns = {'lockdown_role_id', 'auto_lockdown', 'locked_users', 'retention_days', 'log_webhook_url', 'preempt_offenders'}
+                    if not required_columns.issubset(final_columns):
+                        missing = required_columns - final_columns
+                        raise Exception(f"Migration failed: Missing columns {missing}")
+                
+                    print("✅ Database migration completed successfully")
+                except Exception as e:
+                    print(f"❌ Migration error: {e}")
+                    raise
+
+            await db.commit()
+
+            # Incremental auto-vacuum lets maintenance hand freed pages back to the OS
+            async with db.execute('PRAGMA auto_vacuum') as cursor:
+                auto_vacuum = (await cursor.fetchone())[0]
+            if auto_vacuum != 2:
+                await db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                await db.execute('VACUUM')
+                print("✅ Migration: Enabled incremental auto-vacuum")
+
+    async def log_evidence(self, guild_id, user_id, action_type, data):
+        self.last_activity = time.monotonic()
+        async with self.db() as db:
+            await db.execute('''
+                INSERT INTO evidence (guild_id, user_id, action_type, timestamp, data)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (guild_id, user_id, action_type, datetime.utcnow().isoformat(), json.dumps(data)))
+            await db.commit()
+
+    async def log_action(self, guild_id, user_id, action_type, target, bot_action, details, is_raid=False, response_ms=None):
+        self.last_activity = time.monotonic()
+        now = datetime.utcnow().isoformat()
+        raid = int(bool(is_raid))
+        timed = int(response_ms is not None)
+        async with self.db() as db:
+            await db.execute('''
+                INSERT INTO action_log (guild_id, user_id, action_type, target, timestamp, bot_action, details)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (guild_id, user_id, action_type, target, now, bot_action, details))
+
+            # Keep the !guard stats rollups current in the same transaction
+            await db.execute('''
+                INSERT INTO action_stats_hourly (guild_id, hour, action_type, bot_action, count, raid_count, response_ms, response_count)
+                VALUES (?, ?, ?, ?, 1, ?, ?, ?)
+                ON CONFLICT (guild_id, hour, action_type, bot_action) DO UPDATE SET
+                    count = count + 1,
+                    raid_count = raid_count + excluded.raid_count,
+                    response_ms = response_ms + excluded.response_ms,
+                    response_count = response_count + excluded.response_count
+            ''', (guild_id, now[:13], action_type, bot_action, raid, response_ms or 0, timed))
+            await db.execute('''
+                INSERT INTO action_stats_monthly (guild_id, month, action_type, count, raid_count, response_ms, response_count)
+                VALUES (?, ?, ?, 1, ?, ?, ?)
+                ON CONFLICT (guild_id, month, action_type) DO UPDATE SET
+                    count = count + 1,
+                    raid_count = raid_count + excluded.raid_count,
+                    response_ms = response_ms + excluded.response_ms,
+                    response_count = response_count + excluded.response_count
+            ''', (guild_id, now[:7], action_type, raid, response_ms or 0, timed))
+            # user_id 0 marks actions with no offender, such as admin-run mass bans
+            if user_id:
+                await db.execute('''
+                    INSERT INTO offender_stats_monthly (guild_id, month, user_id, count, raid_count)
+                    VALUES (?, ?, ?, 1, ?)
+                    ON CONFLICT (guild_id, month, user_id) DO UPDATE SET
+                        count = count + 1,
+                        raid_count = raid_count + excluded.raid_count
+                ''', (guild_id, now[:7], user_id, raid))
+
+            if bot_action and ('BANNED USER' in bot_action or 'LOCKED DOWN' in bot_action):
+                await db.execute('''
+                    INSERT OR IGNORE INTO offenders (user_id, guild_id, bot_action, added_at)
+                    VALUES (?, ?, ?, ?)
+                ''', (user_id, guild_id, bot_action, now))
+                self.offenders.add(user_id)
+            await db.commit()
+
+    async def export_records(self, guild_id, since, fmt='ndjson', max_bytes=8 * 1024 * 1024):
+        """Stream evidence and action_log rows into gzip parts of at most max_bytes.
+
+        Yields (filename, file object, row count) for each finished part. Parts are
+        spooled to temporary files so the result set is never held in memory.
+        """
+        async with self.db() as db:
+            for table, columns in EXPORT_TABLES.items():
+                query = f"SELECT {', '.join(columns)} FROM {table} WHERE guild_id = ?"
+                params = [guild_id]
+                if since:
+                    query += ' AND timestamp >= ?'
+                    params.append(since.isoformat())
+                query += ' ORDER BY id'
+
+                line_buf = io.StringIO()
+                writer = csv.writer(line_buf)
+                part = 0
+                raw = gz = None
+
+                async with db.execute(query, params) as cursor:
+                    async for row in cursor:
+                        if raw is None:
+                            part += 1
+                            raw = tempfile.TemporaryFile()
+                            gz = gzip.GzipFile(fileobj=raw, mode='wb')
+                            rows = 0
+                            pending = 0
+                            if fmt == 'csv':
+                                writer.writerow(columns)
+
+                        if fmt == 'csv':
+                            writer.writerow(row)
+                            line = line_buf.getvalue()
+                            line_buf.seek(0)
+                            line_buf.truncate()
+                        else:
+                            line = json.dumps(dict(zip(columns, row))) + '\n'
+
+                        data = line.encode('utf-8')
+                        gz.write(data)
+                        rows += 1
+                        pending += len(data)
+
+                        # Sync-flush periodically so raw.tell() is the real compressed size
+                        if pending >= EXPORT_FLUSH_BYTES:
+                            gz.flush()
+                            pending = 0
+                            if raw.tell() + 2 * EXPORT_FLUSH_BYTES >= max_bytes:
+                                gz.close()
+                                raw.seek(0)
+                                yield f"{table}-{guild_id}-part{part}.{fmt}.gz", raw, rows
+                                raw = None
+
+                if raw is not None:
+                    gz.close()
+                    raw.seek(0)
+                    yield f"{table}-{guild_id}-part{part}.{fmt}.gz", raw, rows
+
+    async def send_log(self, guild, embed):
+        config = await self.get_config(guild.id)
+
+        if config.log_webhook_url:
+            self.log_webhooks.enqueue(config.log_webhook_url, embed, lambda embeds: self.webhook_log_failed(guild, embeds))
+            return
+
+        await self.post_log(guild, [embed])
+
+    async def post_log(self, guild, embeds):
+        """Send embeds to the log channel through the bot account"""
+        config = await self.get_config(guild.id)
+    
+        if config.log_channel_id:
+            channel = guild.get_channel(config.log_channel_id)
+            if channel:
+                embeds = list(embeds)
+                while embeds:
+                    batch = take_log_batch(embeds)
+                    try:
+                        async with self.rest.slot(NOTIFY):
+                            await channel.send(embeds=batch)
+                    except discord.HTTPException as e:
+                        if e.status == 400 and len(batch) > 1:
+                            # One embed was rejected; send the rest one by one so only it is lost
+                            for embed in batch:
+                                try:
+                                    async with self.rest.slot(NOTIFY):
+                                        await channel.send(embed=embed)
+                                except:
+                                    pass
+                    except:
+                        pass
+
+    async def webhook_log_failed(self, guild, embeds):
+        """The log webhook is gone: go back to bot delivery and send what was queued"""
+        config = await self.get_config(guild.id)
+        config.log_webhook_url = None
+        await config.save()
+        print(f"⚠️ Log webhook for {guild.name} unusable, falling back to bot delivery")
+        await self.post_log(guild, embeds)
+
+    async def log_webhook_for(self, channel):
+        """URL of the bot's log webhook in a channel, creating it if needed"""
+        async with self.rest.slot(EVIDENCE):
+            webhooks = await channel.webhooks()
+        for webhook in webhooks:
+            if webhook.user and webhook.user.id == self.bot.user.id and webhook.token:
+                return webhook.url
+        async with self.rest.slot(NOTIFY):
+            webhook = await channel.create_webhook(name="Guardian Logs", reason="Guardian log delivery")
+        return webhook.url
+
+    async def send_alert_dm(self, guild, embed, action_type):
+        config = await self.get_config(guild.id)
+
+        if not config.alert_users:
+            return
+
+        for target_id in config.alert_users:
+            try:
+                target = guild.get_member(target_id)
+                if target:
+                    # It's a user
+                    async with self.rest.slot(NOTIFY):
+                        await target.send(f"🚨 **RAID ALERT in {guild.name}** 🚨", embed=embed)
+                    continue
+            
+                # If not a user, check if it's a role
+                role = guild.get_role(target_id)
+                if role:
+                    for member in role.members:
+                        try:
+                            async with self.rest.slot(NOTIFY):
+                                await member.send(f"🚨 **RAID ALERT in {guild.name}** 🚨", embed=embed)
+                        except:
+                            pass
+                    continue
+            
+                # Fallback: fetch user globally (not cached)
+                async with self.rest.slot(NOTIFY):
+                    user = await self.bot.fetch_user(target_id)
+                    await user.send(f"🚨 **RAID ALERT in {guild.name}** 🚨", embed=embed)
+            except Exception as e:
+                print(f"Could not alert target {target_id}: {e}")
+
+    def containment(self, guild, config, user, response, reason):
+        """contain() for a rule response, for use with contain_once"""
+        async def contain():
+            mode = response
+            if mode == 'auto':
+                mode = 'lockdown' if config.auto_lockdown else 'ban'
+
+            if mode == 'lockdown':
+                locked, msg = await self.lockdown_user(guild, user, reason)
+                if locked:
+                    return "USER LOCKED DOWN", "Action Taken", f"User {user.mention} has been LOCKED DOWN (invisible)", True
+                # Fallback to ban
+                banned = await self.ban_user(guild, user, reason)
+                if banned:
+                    return "BANNED USER", "Action Taken", f"User {user.mention} has been BANNED", True
+                return f"Lockdown failed: {msg}, Ban also failed", "Action Failed", "Bot lacks permissions", False
+
+            if mode == 'ban':
+                banned = await self.ban_user(guild, user, reason)
+                if banned:
+                    return "BANNED USER", "Action Taken", f"User {user.mention} has been BANNED immediately", True
+                return "Ban failed - insufficient permissions", "Action Failed", "Bot lacks permission to ban this user", False
+
+            return "Alert sent", "Action Taken", "Alert users notified (rule is alert-only)", True
+        return contain
+
+    async def contain_once(self, guild, user, action_type, embed, contain, evidence, always_alert=False, alert_only=False):
+        """Contain an attacker once; triggers that arrive while it runs or cools down attach to it"""
+        if alert_only:
+            # Alerts never hold the flight, or a stronger rule tripping next would be swallowed
+            (bot_action, field, value, succeeded), first = await contain(), True
+        else:
+            (bot_action, field, value, succeeded), first = await self.respond_once(guild.id, user.id, contain, evidence)
+        if not first:
+            flight = self.responses.get((guild.id, user.id))
+            triggers = len(flight.evidence) if flight else 1
+            embed.add_field(name="Already Handled", value=f"Response to {user.mention} already running: {bot_action}\nTriggers attached: {triggers}", inline=False)
+            return f"{bot_action} (already handled)"
+
+        embed.add_field(name=field, value=value, inline=False)
+        if succeeded or always_alert:
+            await self.send_alert_dm(guild, embed, action_type)
+        return bot_action
+
+    def is_exempt(self, guild, config, user_id):
+        return (
+            user_id == self.bot.user.id
+            or user_id == guild.owner_id
+            or user_id in config.whitelist_users
+            or user_id in config.whitelist_bots
+        )
+
+    async def handle_audit_entry(self, entry, replayed=False):
+        """Evaluate one audit-log entry against the guild's compiled rules"""
+        guild = entry.guild
+        self.audit_cache.record(entry)
+        if replayed or not self.audit_gap:
+            self.note_audit_entry(guild.id, entry.id)
+        else:
+            # The cursor stays put until the gap before this entry is replayed, which skips it
+            self.live_audit_ids[guild.id].add(entry.id)
+        config = await self.get_config(guild.id)
+
+        rule = self.rules.rule_for(config, entry.action)
+        if rule is None or entry.user_id is None or self.is_exempt(guild, config, entry.user_id):
+            return
+
+        user = entry.user or await self.resolve_user(guild, entry.user_id)
+        if user.bot:
+            # Moderation and utility bots act in bulk by design; only what they add is checked
+            return
+        target = describe_target(entry)
+
+        evidence = {'target': target, 'target_id': getattr(entry.target, 'id', None)}
+        if rule.response == 'kick_bot':
+            added = guild.get_member(evidence['target_id']) or await self.fetch_added_member(guild, evidence['target_id'])
+            if added is None or added.id in config.whitelist_bots:
+                return
+            evidence['verified'] = added.public_flags.verified_bot
+            is_mass = not added.public_flags.verified_bot
+        else:
+            # Counted at the entry's own time, so replayed entries fall in the right window
+            age = (discord.utils.utcnow() - entry.created_at).total_seconds()
+            is_mass = self.rules.hit(guild.id, rule, user.id, at=time.monotonic() - max(0, age))
+        evidence['is_mass'] = is_mass
+
+        embed = discord.Embed(
+            title=f"{rule.title.upper()} - RAID DETECTED" if is_mass else rule.title,
+            description=f"**Target:** {target}\n**By:** {user.mention} ({user.id})",
+            color=discord.Color.red() if is_mass else discord.Color.orange(),
+            timestamp=datetime.utcnow()
+        )
+
+        bot_action = "None"
+        if is_mass:
+            self.request_chunk(guild, priority=0)
+            if rule.response == 'kick_bot':
+                try:
+                    async with self.rest.slot(CONTAINMENT):
+                        await added.kick(reason="Anti-Raid: Unverified bot added")
+                    bot_action = "KICKED BOT"
+                    embed.add_field(name="Action Taken", value=f"Bot {added.mention} has been KICKED", inline=False)
+                except:
+                    bot_action = "Kick failed"
+                    embed.add_field(name="Action Failed", value="Bot lacks permission to kick", inline=False)
+                await self.send_alert_dm(guild, embed, rule.name)
+            else:
+                contain = self.containment(guild, config, user, rule.response, f"Anti-Raid: Mass {rule.name.replace('_', ' ')} detected")
+                bot_action = await self.contain_once(guild, user, rule.name, embed, contain, f"{rule.name}: {target}", always_alert=True, alert_only=rule.response == 'alert')
+                if rule.name == 'webhook_create':
+                    deleted, failed = await self.purge_webhooks(guild, {user.id})
+                    bot_action += f", {deleted} webhooks deleted"
+                    embed.add_field(name="Webhooks Deleted", value=f"{deleted} deleted, {failed} failed", inline=False)
+
+        # Evidence is written after containment so it never delays the response
+        # Replayed entries would only measure the outage, not the response
+        response_ms = int((discord.utils.utcnow() - entry.created_at).total_seconds() * 1000) if is_mass and not replayed else None
+        await self.log_evidence(guild.id, user.id, rule.name, evidence)
+        await self.log_action(guild.id, user.id, rule.name, target, bot_action, f"Mass: {is_mass}", is_mass, response_ms)
+        await self.send_log(guild, embed)
+
+    def note_audit_entry(self, guild_id, entry_id):
+        if entry_id > self.audit_cursors.get(guild_id, 0):
+            self.audit_cursors[guild_id] = entry_id
+            self.dirty_audit_cursors.add(guild_id)
+
+    async def load_audit_cursors(self):
+        async with self.db() as db:
+            async with db.execute('SELECT guild_id, entry_id FROM audit_cursor') as cursor:
+                for guild_id, entry_id in await cursor.fetchall():
+                    self.note_audit_entry(guild_id, entry_id)
+        self.dirty_audit_cursors.clear()
+        self.audit_cursors_loaded = True
+
+    async def catch_up_audit_log(self, guild):
+        """Replay audit entries made after the guild's cursor through the rules; returns how many"""
+        cursor = self.audit_cursors.get(guild.id)
+        if cursor is None:
+            # First time this guild is seen: start from its newest entry instead of replaying history
+            async with self.rest.slot(EVIDENCE):
+                latest = [e async for e in guild.audit_logs(limit=1)]
+            self.note_audit_entry(guild.id, latest[0].id if latest else discord.utils.time_snowflake(discord.utils.utcnow()))
+            return 0
+
+        # A long outage only replays its last AUDIT_CATCHUP_MAX_AGE
+        oldest = discord.utils.time_snowflake(discord.utils.utcnow() - timedelta(seconds=AUDIT_CATCHUP_MAX_AGE))
+        after = max(cursor, oldest)
+        replayed = 0
+        while True:
+            async with self.rest.slot(EVIDENCE):
+                entries = [e async for e in guild.audit_logs(limit=100, after=discord.Object(id=after))]
+            if not entries:
+                break
+            entries.sort(key=lambda e: e.id)
+            for entry in entries:
+                if entry.id in self.live_audit_ids[guild.id]:
+                    continue
+                try:
+                    await self.handle_audit_entry(entry, replayed=True)
+                except Exception as e:
+                    print(f"Replaying audit entry {entry.id} in {guild.id} failed: {e}")
+                replayed += 1
+            after = entries[-1].id
+            if len(entries) < 100:
+                break
+        return replayed
+
+    async def acquire_lease(self):
+        """Take or renew this cluster's gateway lease; True while this process holds it.
+        The upsert only overwrites a lease that is ours or has expired, so two
+        processes sharing guardian.db never both hold it."""
+        now = time.time()
+        async with self.db() as db:
+            if not self.lease_table_ready:
+                await db.execute(LEASE_TABLE)
+                self.lease_table_ready = True
+            await db.execute('''
+                INSERT INTO lease (cluster_id, holder, expires_at, acquired_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(cluster_id) DO UPDATE SET
+                    holder = excluded.holder,
+                    expires_at = excluded.expires_at,
+                    acquired_at = CASE WHEN lease.holder = excluded.holder THEN lease.acquired_at ELSE excluded.acquired_at END
+                WHERE lease.holder = excluded.holder OR lease.expires_at < ?
+            ''', (self.cluster_id, self.lease_holder, now + LEASE_TTL, datetime.utcnow().isoformat(), now))
+            await db.commit()
+            async with db.execute('SELECT holder FROM lease WHERE cluster_id = ?', (self.cluster_id,)) as cursor:
+                row = await cursor.fetchone()
+        held = row is not None and row[0] == self.lease_holder
+        if held:
+            self.lease_expires = now + LEASE_TTL
+        return held
+
+    async def release_lease(self):
+        """Expire our lease now so a standby takes over without waiting out the TTL"""
+        async with self.db() as db:
+            await db.execute('UPDATE lease SET expires_at = 0 WHERE cluster_id = ? AND holder = ?', (self.cluster_id, self.lease_holder))
+            await db.commit()
+        self.lease_expires = 0
+
+    async def warm_standby(self):
+        """Keep configs, offenders and audit cursors loaded while another process is active"""
+        # One query for every guild rather than a connection per Config.load
+        async with self.db() as db:
+            async with db.execute('SELECT * FROM configs') as cursor:
+                rows = await cursor.fetchall()
+        self.configs = {row[0]: Config.from_row(row[0], row, self.db_path) for row in rows}
+        await self.load_offenders()
+        await self.load_audit_cursors()
+
+    async def wait_for_lease(self):
+        """Run as a standby until the active process's lease lapses, then hold it"""
+        last_warm = 0
+        announced = False
+        while not await self.acquire_lease():
+            if not announced:
+                print(f"⏸️ Standby for cluster {self.cluster_id}; waiting for the active lease to expire")
+                announced = True
+            if time.monotonic() - last_warm >= STANDBY_WARM_INTERVAL:
+                try:
+                    await self.warm_standby()
+                except Exception as e:
+                    print(f"Warming standby caches failed: {e}")
+                last_warm = time.monotonic()
+            await asyncio.sleep(LEASE_RENEW_INTERVAL)
+        # The old holder may have advanced its cursors since the last warm-up; the
+        # catch-up reloads them once init_db has run
+        self.audit_cursors_loaded = False
+        print(f"▶️ Holding the lease for cluster {self.cluster_id} as {self.lease_holder}")
+
+    async def checkpoint_trackers(self):
+        """Save the sliding-window trackers so a restart resumes counting where it left off.
+        The audit cursors go in the same transaction, and entries counted during a
+        gap (not yet under a cursor) go in the blob, so the catch-up after a
+        restart never counts an entry twice"""
+        now, wall = time.monotonic(), time.time()
+        epoch = datetime(1970, 1, 1)
+        records = [
+            (guild_id, RULE_HITS, name, key, [wall - (now - t) for t in times])
+            for (guild_id, name, key), times in self.rules.hits.items()
+        ]
+        records.extend(
+            (guild_id, ACTION_TRACKER, '', user_id, [(t - epoch).total_seconds() for t in times])
+            for guild_id, users in self.action_tracker.items()
+            for user_id, times in users.items()
+        )
+        counted = [(guild_id, entry_id) for guild_id, entry_ids in self.live_audit_ids.items() for entry_id in entry_ids]
+        data = pack_trackers(records, wall, counted)
+        # Taken together with the hits above, before anything else can run
+        saved_at = datetime.utcnow().isoformat()
+        cursors = [(guild_id, self.audit_cursors[guild_id], saved_at) for guild_id in self.dirty_audit_cursors]
+        async with self.db() as db:
+            await db.execute('''
+                INSERT OR REPLACE INTO tracker_checkpoint (cluster_id, data, saved_at) VALUES (?, ?, ?)
+            ''', (self.cluster_id, data, saved_at))
+            await db.executemany('''
+                INSERT OR REPLACE INTO audit_cursor (guild_id, entry_id, updated_at) VALUES (?, ?, ?)
+            ''', cursors)
+            await db.commit()
+        for guild_id, entry_id, _ in cursors:
+            if self.audit_cursors[guild_id] == entry_id:
+                self.dirty_audit_cursors.discard(guild_id)
+        return len(data)
+
+    async def restore_trackers(self):
+        """Load this process's last checkpoint, dropping anything older than TRACKER_MAX_AGE"""
+        async with self.db() as db:
+            async with db.execute('SELECT data FROM tracker_checkpoint WHERE cluster_id = ?', (self.cluster_id,)) as cursor:
+                row = await cursor.fetchone()
+        if not row:
+            return 0
+        try:
+            _, records, counted = unpack_trackers(row[0])
+        except (ValueError, struct.error) as e:
+            print(f"Ignoring unreadable tracker checkpoint: {e}")
+            return 0
+
+        now, wall = time.monotonic(), time.time()
+        cutoff = wall - TRACKER_MAX_AGE
+        restored = 0
+        for guild_id, kind, name, key, times in records:
+            times = sorted(t for t in times if cutoff <= t <= wall)
+            if not times:
+                continue
+            if kind == RULE_HITS:
+                hits = self.rules.hits.setdefault((guild_id, name, key), deque())
+                hits.extend(now - (wall - t) for t in times)
+            else:
+                self.action_tracker[guild_id][key].extend(datetime.utcfromtimestamp(t) for t in times)
+            restored += 1
+        # Already counted before the restart, so the audit catch-up skips them
+        for guild_id, entry_id in counted:
+            self.live_audit_ids[guild_id].add(entry_id)
+        return restored
+
+    def note_disconnect(self):
+        """Hold the audit cursors until whatever is missed from here has been replayed"""
+        self.audit_gap = True
+        self.audit_disconnects += 1
+
+    def start_audit_catch_up(self, guilds):
+        """Start a catch-up, or have the running one go round again"""
+        if self.audit_catch_up_task is None or self.audit_catch_up_task.done():
+            self.audit_catch_up_task = asyncio.ensure_future(self.catch_up_audit_logs(guilds))
+        else:
+            self.audit_catch_up_again = True
+        return self.audit_catch_up_task
+
+    async def catch_up_audit_logs(self, guilds):
+        """Catch up every guild after a restart or reconnect, a few guilds at a time"""
+        if not self.audit_cursors_loaded:
+            await self.load_audit_cursors()
+        semaphore = asyncio.Semaphore(AUDIT_CATCHUP_CONCURRENCY)
+
+        async def catch_up(guild):
+            async with semaphore:
+                try:
+                    replayed = await self.catch_up_audit_log(guild)
+                    if replayed:
+                        print(f"📜 Replayed {replayed} missed audit log entries in {guild.name}")
+                except discord.Forbidden:
+                    pass
+                except Exception as e:
+                    print(f"Audit log catch-up failed for {guild.id}: {e}")
+
+        while True:
+            generation = self.audit_disconnects
+            self.audit_catch_up_again = False
+            await asyncio.gather(*(catch_up(guild) for guild in guilds))
+            if self.audit_disconnects == generation:
+                break
+            # The connection dropped mid-run, so guilds already done have a new gap
+            if not self.audit_catch_up_again:
+                # Still disconnected; on_resumed/on_ready starts the next catch-up
+                return
+
+        # Entries that arrived live during the catch-up can move the cursors now
+        live, self.live_audit_ids = self.live_audit_ids, defaultdict(set)
+        self.audit_gap = False
+        for guild_id, entry_ids in live.items():
+            if entry_ids:
+                self.note_audit_entry(guild_id, max(entry_ids))
+        await self.checkpoint_trackers()
+
+    async def fetch_added_member(self, guild, member_id):
+        """The bot_add audit entry can arrive before GUILD_MEMBER_ADD, so ask the API,
+        retrying briefly; None if the bot never shows up (e.g. already removed)"""
+        if member_id is None:
+            return None
+        for attempt in range(BOT_ADD_FETCH_RETRIES):
+            member = guild.get_member(member_id)
+            if member is not None:
+                return member
+            try:
+                async with self.rest.slot(EVIDENCE):
+                    return await guild.fetch_member(member_id)
+            except discord.NotFound:
+                await asyncio.sleep(BOT_ADD_FETCH_DELAY)
+            except discord.HTTPException:
+                return None
+        return None
+
+    async def resolve_user(self, guild, user_id):
+        user = guild.get_member(user_id) or self.bot.get_user(user_id)
+        if user is None:
+            async with self.rest.slot(EVIDENCE):
+                user = await self.bot.fetch_user(user_id)
+        return user
+
+    def webhook_creator(self, guild, webhook):
+        """Who made a webhook: the pushed audit entry first, the webhook's own creator field second"""
+        for entry in self.audit_cache.pushed.get((guild.id, discord.AuditLogAction.webhook_create), ()):
+            if entry.target is not None and entry.target.id == webhook.id:
+                return entry.user_id
+        return webhook.user.id if webhook.user else None
+
+    async def purge_webhooks(self, guild, actor_ids):
+        """Delete every webhook made by actor_ids, across all channels in parallel; returns (deleted, failed)"""
+        async with self.rest.slot(EVIDENCE):
+            webhooks = await guild.webhooks()
+        rogue = [w for w in webhooks if self.webhook_creator(guild, w) in actor_ids]
+
+        semaphore = asyncio.Semaphore(CHANNEL_EDIT_CONCURRENCY)
+        deleted = failed = 0
+
+        async def delete(webhook):
+            nonlocal deleted, failed
+            async with semaphore, self.rest.slot(CONTAINMENT):
+                try:
+                    await webhook.delete(reason="Anti-Raid: Webhook abuse")
+                    deleted += 1
+                except Exception:
+                    failed += 1
+
+        await asyncio.gather(*(delete(w) for w in rogue))
+        return deleted, failed
+
+    async def handle_webhooks_update(self, channel):
+        """Per-channel webhook velocity; contain whoever made the burst of webhooks.
+        WEBHOOKS_UPDATE also fires on edits and deletes, so only webhook ids not
+        seen in an earlier listing of the channel count as creations"""
+        guild = channel.guild
+        config = await self.get_config(guild.id)
+        rule = self.rules.rule_for(config, discord.AuditLogAction.webhook_create)
+        if rule is None:
+            return
+
+        async with self.rest.slot(EVIDENCE):
+            webhooks = await channel.webhooks()
+        known = self.channel_webhooks.get(channel.id)
+        if known is None:
+            # First listing of this channel: only webhooks made within the window are new
+            since = discord.utils.utcnow() - timedelta(seconds=rule.window)
+            new = [w for w in webhooks if w.created_at >= since]
+            known = self.channel_webhooks[channel.id] = set()
+        else:
+            new = [w for w in webhooks if w.id not in known]
+        # Ids are never reused, so deleted ones can stay and an out-of-order listing never recounts
+        known.update(w.id for w in webhooks)
+        if not new:
+            return
+
+        now = time.monotonic()
+        created = self.new_webhooks[channel.id]
+        is_mass = False
+        for webhook in new:
+            created.append((now, self.webhook_creator(guild, webhook)))
+            is_mass = self.rules.hit(guild.id, rule, f"channel:{channel.id}")
+        while created and created[0][0] < now - rule.window:
+            created.popleft()
+        if not is_mass:
+            return
+
+        made = Counter(creator for _, creator in created if creator is not None)
+        # Someone who made a single webhook during another account's burst is left alone
+        actors = {a for a, n in made.items() if n >= 2 and not self.is_exempt(guild, config, a)}
+
+        for actor_id in actors:
+            user = await self.resolve_user(guild, actor_id)
+            if user.bot:
+                continue
+            embed = discord.Embed(
+                title="WEBHOOK SPAM - RAID DETECTED",
+                description=f"**Channel:** {channel.mention}\n**Created by:** {user.mention} ({actor_id})",
+                color=discord.Color.red(),
+                timestamp=datetime.utcnow()
+            )
+            contain = self.containment(guild, config, user, rule.response, "Anti-Raid: Webhook spam detected")
+            bot_action = await self.contain_once(guild, user, 'webhook_create', embed, contain, f"webhook burst in #{channel.name}", always_alert=True, alert_only=rule.response == 'alert')
+            deleted, failed = await self.purge_webhooks(guild, {actor_id})
+            embed.add_field(name="Webhooks Deleted", value=f"{deleted} deleted, {failed} failed", inline=False)
+
+            await self.log_evidence(guild.id, actor_id, 'webhook_create', {
+                'target': f"#{channel.name}",
+                'target_id': channel.id,
+                'deleted_webhooks': deleted,
+                'is_mass': True
+            })
+            await self.log_action(guild.id, actor_id, 'webhook_create', f"#{channel.name}", f"{bot_action}, {deleted} webhooks deleted", "Mass: True (channel velocity)", True)
+            await self.send_log(guild, embed)
+
+    async def load_offenders(self):
+        """Pull offenders recorded since the last load, including ones other processes added"""
+        async with self.db() as db:
+            async with db.execute('''
+                SELECT user_id, added_at FROM offenders WHERE added_at > ? ORDER BY added_at
+            ''', (self.offenders.loaded_until,)) as cursor:
+                rows = await cursor.fetchall()
+        if rows:
+            self.offenders.extend(user_id for user_id, _ in rows)
+            self.offenders.loaded_until = rows[-1][1]
+        return len(rows)
+
+    async def load_invites(self, guild):
+        """Take the baseline invite counts for a guild (needs Manage Server)"""
+        try:
+            async with self.rest.slot(EVIDENCE):
+                invites = await guild.invites()
+        except discord.HTTPException:
+            return False
+        self.invites.snapshot(guild.id, invites)
+        return True
+
+    async def load_all_invites(self, guilds):
+        """Baseline every guild not loaded yet, a few at a time"""
+        semaphore = asyncio.Semaphore(INVITE_LOAD_CONCURRENCY)
+
+        async def load(guild):
+            async with semaphore:
+                await self.load_invites(guild)
+
+        await asyncio.gather(*(load(g) for g in guilds if g.id not in self.invites.uses))
+
+    def queue_join(self, member):
+        """Batch joins so one guild.invites() diff covers a whole burst"""
+        self.join_queues[member.guild.id].append(member)
+        task = self.join_tasks.get(member.guild.id)
+        if task is None or task.done():
+            self.join_tasks[member.guild.id] = asyncio.ensure_future(self.attribute_joins(member.guild))
+
+    async def attribute_joins(self, guild):
+        while self.join_queues[guild.id]:
+            # Let the burst build up so it is diffed in one fetch
+            await asyncio.sleep(INVITE_DIFF_DELAY)
+            if guild.id not in self.invites.uses:
+                # No baseline yet: this fetch becomes it, and the queued joins stay unattributed
+                self.join_queues[guild.id] = []
+                await self.load_invites(guild)
+                return
+            try:
+                async with self.rest.slot(EVIDENCE):
+                    invites = await guild.invites()
+            except discord.HTTPException:
+                self.join_queues[guild.id] = []
+                return
+
+            batch = self.join_queues[guild.id]
+            self.join_queues[guild.id] = []
+            increases = self.invites.diff(guild.id, invites)
+            try:
+                await self.check_invite_spikes(guild, invites, increases, batch)
+            except Exception as e:
+                print(f"Invite spike check failed for {guild.id}: {e}")
+
+    async def check_invite_spikes(self, guild, invites, increases, batch):
+        config = await self.get_config(guild.id)
+        settings = config.thresholds.get('invite_spike', {})
+        if not increases or not settings.get('enabled', True):
+            return
+        rule = CompiledRule('invite_spike', None, "Invite Join Spike", settings.get('count', 10), settings.get('window', 60), 'lockdown')
+
+        # Members can only be tied to an invite when the whole batch used one code
+        single = len(increases) == 1
+        for code, delta in increases.items():
+            joined = self.invites.record_joins(guild.id, code, [m.id for m in batch if not m.bot] if single else [], rule.window)
+            spiked = False
+            for _ in range(delta):
+                spiked = self.rules.hit(guild.id, rule, f"invite:{code}")
+            if spiked:
+                invite = next((i for i in invites if i.code == code), None)
+                await self.contain_invite_raid(guild, config, invite, code, joined)
+
+    async def contain_invite_raid(self, guild, config, invite, code, joined):
+        """Revoke the invite a join spike came through and lock down who used it"""
+        embed = discord.Embed(
+            title="INVITE RAID DETECTED",
+            description=f"**Invite:** `{code}`" + (f"\n**Created by:** {invite.inviter.mention}" if invite and invite.inviter else ""),
+            color=discord.Color.red(),
+            timestamp=datetime.utcnow()
+        )
+
+        revoked = False
+        if invite is not None:
+            try:
+                async with self.rest.slot(CONTAINMENT):
+                    await invite.delete(reason="Anti-Raid: Join spike through this invite")
+                revoked = True
+                self.invites.remove(invite)
+            except discord.HTTPException:
+                pass
+        embed.add_field(name="Invite", value="REVOKED" if revoked else "Could not revoke", inline=False)
+
+        members = [m for m in (guild.get_member(mid) for mid in joined) if m and not self.is_exempt(guild, config, m.id)]
+        locked, failed = await self.lockdown_users(guild, members, f"Anti-Raid: Joined through raided invite {code}")
+        self.invites.joins.pop((guild.id, code), None)
+        embed.add_field(name="Joined Accounts", value=f"{len(locked)} locked down, {len(failed)} failed", inline=False)
+
+        bot_action = f"Invite {'revoked' if revoked else 'not revoked'}, {len(locked)} joiners locked down"
+        # The inviter is usually whoever made the public invite, not an offender
+        inviter = f", created by {invite.inviter} ({invite.inviter.id})" if invite and invite.inviter else ""
+        await self.log_action(guild.id, 0, 'invite_spike', code, bot_action, f"Joiners: {len(joined)}{inviter}", True)
+        await self.send_log(guild, embed)
+        await self.send_alert_dm(guild, embed, 'invite_spike')
+
+    async def handle_known_offender(self, member):
+        """A raider contained in another guild joined; lock them down if the guild opted in"""
+        guild = member.guild
+        config = await self.get_config(guild.id)
+        if self.is_exempt(guild, config, member.id):
+            return
+
+        embed = discord.Embed(
+            title="KNOWN RAIDER JOINED",
+            description=f"**Member:** {member.mention} ({member.id})\nThis account was banned or locked down as a raider in another protected server.",
+            color=discord.Color.orange(),
+            timestamp=datetime.utcnow()
+        )
+
+        bot_action = "Alert only (pre-emptive lockdown off)"
+        if config.preempt_offenders:
+            locked, msg = await self.lockdown_user(guild, member, "Anti-Raid: Known raider (pre-emptive)")
+            if locked:
+                bot_action = "USER LOCKED DOWN (pre-emptive)"
+                embed.add_field(name="Action Taken", value=f"{member.mention} has been LOCKED DOWN pre-emptively", inline=False)
+                await self.send_alert_dm(guild, embed, 'known_raider')
+            else:
+                bot_action = f"Pre-emptive lockdown failed: {msg}"
+                embed.add_field(name="Action Failed", value=msg, inline=False)
+        else:
+            embed.add_field(name="Pre-emptive Lockdown", value="Off - enable with `!guard preempt on`", inline=False)
+
+        await self.log_action(guild.id, member.id, 'known_raider', str(member), bot_action, "Cross-guild offender index")
+        await self.send_log(guild, embed)
+
+    async def respond_once(self, guild_id, user_id, contain, evidence=None):
+        """Run contain() once per (guild, user) per cooldown; returns (result, first).
+
+        Handlers that trip on the same attacker while a response is running,
+        or within RESPONSE_COOLDOWN of it finishing, get the same result back
+        instead of issuing their own ban or lockdown.
+        """
+        key = (guild_id, user_id)
+        now = time.monotonic()
+        flight = self.responses.get(key)
+        if flight and (flight.finished is None or now - flight.finished < RESPONSE_COOLDOWN):
+            if evidence is not None:
+                flight.evidence.append(evidence)
+            return await asyncio.shield(flight.task), False
+
+        for stale in [k for k, f in self.responses.items() if f.finished is not None and now - f.finished >= RESPONSE_COOLDOWN]:
+            del self.responses[stale]
+
+        flight = ResponseFlight(asyncio.ensure_future(contain()), evidence)
+        self.responses[key] = flight
+        return await asyncio.shield(flight.task), True
+
+    async def check_mass_action(self, guild_id, user_id, action_type):
+        now = datetime.utcnow()
+        config = await self.get_config(guild_id)
+    
+        if action_type not in config.thresholds:
+            return False
+    
+        threshold = config.thresholds[action_type]
+    
+        if not threshold.get('enabled', True):
+            return False
+    
+        window = threshold['window']
+        max_count = threshold['count']
+    
+        cutoff = now - timedelta(seconds=window)
+        self.action_tracker[guild_id][user_id] = [
+            t for t in self.action_tracker[guild_id][user_id] if t > cutoff
+        ]
+    
+        self.action_tracker[guild_id][user_id].append(now)
+    
+        is_mass = len(self.action_tracker[guild_id][user_id]) >= max_count
+        if is_mass:
+            self.request_chunk(self.bot.get_guild(guild_id), priority=0)
+        return is_mass
+
+    async def create_backup(self, guild):
+        # Role assignments come from the member cache
+        await self.ensure_chunked(guild)
+        backup_data = {
+            'roles': [{'id': r.id, 'name': r.name, 'permissions': r.permissions.value, 'color': r.color.value, 'position': r.position} for r in guild.roles],
+            'channels': [{'id': c.id, 'name': c.name, 'type': str(c.type), 'position': c.position} for c in guild.channels],
+            'role_members': self.role_members.snapshot(guild),
+            'timestamp': datetime.utcnow().isoformat()
+        }
+    
+        async with self.db() as db:
+            cursor = await db.execute('''
+                INSERT INTO backups (guild_id, timestamp, data)
+                VALUES (?, ?, ?)
+            ''', (guild.id, datetime.utcnow().isoformat(), json.dumps(backup_data)))
+            await db.commit()
+            return cursor.lastrowid
+
+    def request_chunk(self, guild, priority=1):
+        """Queue a guild for background chunking; lower priority values go first"""
+        if guild is None or guild.chunked:
+            return
+        # Guilds under attack jump the queue, then smaller guilds finish first
+        heapq.heappush(self.chunk_queue, (priority, guild.member_count or 0, guild.id))
+        self.chunk_wakeup.set()
+
+    async def ensure_chunked(self, guild):
+        """Fill the member cache for one guild, sharing the request between callers"""
+        if guild.chunked:
+            return
+        task = self.chunk_tasks.get(guild.id)
+        if task is None:
+            task = asyncio.ensure_future(guild.chunk(cache=True))
+            self.chunk_tasks[guild.id] = task
+            task.add_done_callback(lambda _: self.chunk_tasks.pop(guild.id, None))
+        await asyncio.shield(task)
+
+    async def run_chunker(self):
+        """Chunk queued guilds one at a time in priority order"""
+        while True:
+            await self.chunk_wakeup.wait()
+            while self.chunk_queue:
+                _, _, guild_id = heapq.heappop(self.chunk_queue)
+                guild = self.bot.get_guild(guild_id)
+                if guild is None or guild.chunked:
+                    continue
+                try:
+                    await self.ensure_chunked(guild)
+                except Exception as e:
+                    print(f"Chunking guild {guild_id} failed: {e}")
+            self.chunk_wakeup.clear()
+
+    async def load_lock_expiries(self):
+        """Rebuild the expiry heap from lock_expiry for the guilds this process serves"""
+        async with self.db() as db:
+            async with db.execute('SELECT guild_id, user_id, expires_at FROM lock_expiry') as cursor:
+                rows = await cursor.fetchall()
+
+        for guild_id, user_id, expires_at in rows:
+            # Guilds on other shards/clusters are left to the process that owns them
+            if self.bot.get_guild(guild_id) is None:
+                continue
+            expires_at = datetime.fromisoformat(expires_at)
+            self.lock_expiries[(guild_id, user_id)] = expires_at
+            self.expiry_heap.append((expires_at, guild_id, user_id))
+        heapq.heapify(self.expiry_heap)
+        self.expiry_wakeup.set()
+        return len(self.lock_expiries)
+
+    async def schedule_unlocks(self, guild_id, user_ids, expires_at):
+        """Persist an expiry for each user and push it onto the heap"""
+        async with self.db() as db:
+            await db.executemany('''
+                INSERT OR REPLACE INTO lock_expiry (guild_id, user_id, expires_at)
+                VALUES (?, ?, ?)
+            ''', [(guild_id, user_id, expires_at.isoformat()) for user_id in user_ids])
+            await db.commit()
+
+        for user_id in user_ids:
+            self.lock_expiries[(guild_id, user_id)] = expires_at
+            heapq.heappush(self.expiry_heap, (expires_at, guild_id, user_id))
+        self.expiry_wakeup.set()
+
+    async def cancel_unlocks(self, guild_id, user_ids):
+        """Drop pending expiries; stale heap entries are skipped when they surface"""
+        user_ids = [uid for uid in user_ids if self.lock_expiries.pop((guild_id, uid), None) is not None]
+        if user_ids:
+            await self.delete_lock_expiries(guild_id, user_ids)
+
+    async def delete_lock_expiries(self, guild_id, user_ids):
+        async with self.db() as db:
+            await db.executemany(
+                'DELETE FROM lock_expiry WHERE guild_id = ? AND user_id = ?',
+                [(guild_id, user_id) for user_id in user_ids]
+            )
+            await db.commit()
+
+    async def expire_locks(self):
+        """Unlock every user whose expiry has passed, batched per guild"""
+        now = datetime.utcnow()
+        due = defaultdict(list)
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires_at, guild_id, user_id = heapq.heappop(self.expiry_heap)
+            # Cancelled or rescheduled since this entry was pushed
+            if self.lock_expiries.get((guild_id, user_id)) != expires_at:
+                continue
+            del self.lock_expiries[(guild_id, user_id)]
+            due[guild_id].append(user_id)
+
+        for guild_id, user_ids in due.items():
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                continue
+
+            config = await self.get_config(guild_id)
+            # Without the role there is nothing left to remove, so failures are not retried
+            role_exists = bool(config.lockdown_role_id and guild.get_role(config.lockdown_role_id))
+            unlocked, departed, retry = [], [], []
+            for i in range(0, len(user_ids), EXPIRY_BATCH):
+                batch = [discord.Object(id=uid) for uid in user_ids[i:i + EXPIRY_BATCH]]
+                done, failed = await self.unlock_users(guild, batch, "Lockdown expired")
+                unlocked.extend(done)
+                for uid, error in failed.items():
+                    if error == NOT_IN_SERVER:
+                        departed.append(uid)
+                    elif role_exists:
+                        retry.append(uid)
+                        print(f"Expired lockdown for {uid} in {guild.name} not lifted: {error}")
+
+            # Members who left lost the role already, so stop tracking them
+            if any(uid in config.locked_users for uid in departed):
+                config.locked_users.difference_update(departed)
+                await config.save()
+
+            await self.delete_lock_expiries(guild_id, [uid for uid in user_ids if uid not in retry])
+            if retry:
+                await self.schedule_unlocks(guild_id, retry, now + timedelta(seconds=EXPIRY_RETRY_DELAY))
+            print(f"⏰ Lifted {len(unlocked)} expired lockdowns in {guild.name}")
+
+    async def run_lock_expiry(self):
+        """Single timer for every timed lockdown, sleeping until the earliest expiry"""
+        await self.bot.wait_until_ready()
+        await self.load_lock_expiries()
+        while True:
+            timeout = None
+            if self.expiry_heap:
+                timeout = max(0.0, (self.expiry_heap[0][0] - datetime.utcnow()).total_seconds())
+            try:
+                await asyncio.wait_for(self.expiry_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.expiry_wakeup.clear()
+            try:
+                await self.expire_locks()
+            except Exception as e:
+                print(f"Lock expiry error: {e}")
+
+    async def save_metrics(self):
+        async with self.db() as db:
+            await db.execute('''
+                INSERT OR REPLACE INTO process_metrics
+                (cluster_id, pid, shard_ids, guilds, latency_ms, events, events_per_min, loop_lag_ms, rss_kb, uptime, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', self.metrics.snapshot(self.bot))
+            await db.commit()
+
+    def db_size(self):
+        """Bytes used by guardian.db including its WAL file"""
+        return sum(os.path.getsize(path) for path in (self.db_path, self.db_path + '-wal') if os.path.exists(path))
+
+    async def compact_evidence(self, db, guild_id, cutoff):
+        """Roll expired evidence rows into evidence_daily and delete them in small batches"""
+        removed = 0
+        while True:
+            async with db.execute('''
+                SELECT id, action_type, timestamp, data FROM evidence
+                WHERE guild_id = ? AND timestamp < ?
+                ORDER BY timestamp LIMIT ?
+            ''', (guild_id, cutoff, MAINTENANCE_BATCH)) as cursor:
+                rows = await cursor.fetchall()
+            if not rows:
+                return removed
+
+            counts = Counter()
+            mass = Counter()
+            for _, action_type, timestamp, data in rows:
+                key = (timestamp[:10], action_type)
+                counts[key] += 1
+                try:
+                    if json.loads(data).get('is_mass'):
+                        mass[key] += 1
+                except:
+                    pass
+
+            await db.executemany('''
+                INSERT INTO evidence_daily (guild_id, day, action_type, count, mass_count)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (guild_id, day, action_type)
+                DO UPDATE SET count = count + excluded.count, mass_count = mass_count + excluded.mass_count
+            ''', [(guild_id, day, action_type, n, mass[(day, action_type)]) for (day, action_type), n in counts.items()])
+            await db.executemany('DELETE FROM evidence WHERE id = ?', [(row[0],) for row in rows])
+            await db.commit()
+            removed += len(rows)
+
+            # Yield between batches so writers are never blocked for long
+            await asyncio.sleep(0.05)
+
+    async def compact_action_log(self, db, guild_id, cutoff):
+        """Roll expired action_log rows into action_log_daily and delete them in small batches"""
+        removed = 0
+        while True:
+            async with db.execute('''
+                SELECT id, action_type, bot_action, timestamp FROM action_log
+                WHERE guild_id = ? AND timestamp < ?
+                ORDER BY timestamp LIMIT ?
+            ''', (guild_id, cutoff, MAINTENANCE_BATCH)) as cursor:
+                rows = await cursor.fetchall()
+            if not rows:
+                return removed
+
+            counts = Counter((timestamp[:10], action_type, bot_action) for _, action_type, bot_action, timestamp in rows)
+            await db.executemany('''
+                INSERT INTO action_log_daily (guild_id, day, action_type, bot_action, count)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (guild_id, day, action_type, bot_action)
+                DO UPDATE SET count = count + excluded.count
+            ''', [(guild_id, day, action_type, bot_action, n) for (day, action_type, bot_action), n in counts.items()])
+            await db.executemany('DELETE FROM action_log WHERE id = ?', [(row[0],) for row in rows])
+            await db.commit()
+            removed += len(rows)
+
+            await asyncio.sleep(0.05)
+
+    async def prune_backups(self, db, guild_id, cutoff):
+        """Delete backups older than the retention window, always keeping the newest few"""
+        cursor = await db.execute('''
+            DELETE FROM backups
+            WHERE guild_id = ? AND timestamp < ?
+            AND id NOT IN (SELECT id FROM backups WHERE guild_id = ? ORDER BY id DESC LIMIT ?)
+        ''', (guild_id, cutoff, guild_id, MIN_BACKUPS_KEPT))
+        await db.commit()
+        return cursor.rowcount
+
+    async def run_maintenance(self, force_vacuum=False):
+        """Enforce retention windows, then reclaim free pages if the bot is quiet"""
+        size_before = self.db_size()
+        stats = {'evidence': 0, 'action_log': 0, 'backups': 0, 'vacuumed': False}
+
+        async with self.db() as db:
+            async with db.execute('SELECT guild_id, retention_days FROM configs') as cursor:
+                retention = {guild_id: days for guild_id, days in await cursor.fetchall()}
+            async with db.execute('''
+                SELECT guild_id FROM evidence
+                UNION SELECT guild_id FROM action_log
+                UNION SELECT guild_id FROM backups
+            ''') as cursor:
+                guild_ids = [row[0] for row in await cursor.fetchall()]
+
+            for guild_id in guild_ids:
+                if guild_id in self.configs:
+                    days = self.configs[guild_id].retention_days
+                else:
+                    days = retention.get(guild_id)
+                if days is None:
+                    days = DEFAULT_RETENTION_DAYS
+                if days <= 0:
+                    continue
+
+                cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+                stats['evidence'] += await self.compact_evidence(db, guild_id, cutoff)
+                stats['action_log'] += await self.compact_action_log(db, guild_id, cutoff)
+                stats['backups'] += await self.prune_backups(db, guild_id, cutoff)
+
+            # Only give pages back while no raid is being logged
+            if force_vacuum or time.monotonic() - self.last_activity >= QUIET_PERIOD:
+                # executescript steps the pragma to completion; execute() frees a single page
+                await db.executescript('PRAGMA incremental_vacuum;')
+                await db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                stats['vacuumed'] = True
+
+        stats['reclaimed_bytes'] = max(size_before - self.db_size(), 0)
+        stats['finished'] = datetime.utcnow().isoformat()
+        self.maintenance_stats.update(stats)
+        print(f"🧹 Maintenance: removed {stats['evidence']} evidence, {stats['action_log']} action_log, "
+              f"{stats['backups']} backups rows; reclaimed {stats['reclaimed_bytes']} bytes")
+        return stats
+
+    async def ban_user(self, guild, user, reason):
+        try:
+            async with self.rest.slot(CONTAINMENT):
+                await guild.ban(user, reason=reason, delete_message_days=0)
+            return True
+        except:
+            return False
+
+    async def ban_users(self, guild, users, reason):
+        """Ban many users with at most BAN_CONCURRENCY requests in flight; returns (banned ids, {id: error})"""
+        semaphore = asyncio.Semaphore(BAN_CONCURRENCY)
+        banned, failed = [], {}
+
+        async def apply(user):
+            async with semaphore, self.rest.slot(CONTAINMENT):
+                try:
+                    await guild.ban(user, reason=reason, delete_message_days=0)
+                    banned.append(user.id)
+                except Exception as e:
+                    failed[user.id] = str(e)
+
+        unique = {user.id: user for user in users}
+        await asyncio.gather(*(apply(user) for user in unique.values()))
+        return banned, failed
+
+    async def reassign_roles(self, guild, assignments, reason):
+        """Give members their roles back, one request per member, at most
+        ROLE_RESTORE_CONCURRENCY in flight; assignments is {member id: [roles]}.
+        Returns (members restored, members failed or gone)"""
+        await self.ensure_chunked(guild)
+        semaphore = asyncio.Semaphore(ROLE_RESTORE_CONCURRENCY)
+        restored = failed = 0
+
+        async def apply(member, roles):
+            nonlocal restored, failed
+            async with semaphore, self.rest.slot(CONTAINMENT):
+                try:
+                    await member.add_roles(*roles, reason=reason)
+                    restored += 1
+                except Exception:
+                    failed += 1
+
+        tasks = []
+        for member_id, roles in assignments.items():
+            member = guild.get_member(member_id)
+            if member is None:
+                failed += 1
+                continue
+            missing = [r for r in roles if r not in member.roles]
+            if missing:
+                tasks.append(apply(member, missing))
+        await asyncio.gather(*tasks)
+        return restored, failed
+
+    async def _apply_lock_role(self, guild, users, add, reason):
+        """Add or remove the lockdown role for many users; returns (changed ids, {id: error})"""
+        config = await self.get_config(guild.id)
+
+        lockdown_role = None
+        if config.lockdown_role_id:
+            lockdown_role = guild.get_role(config.lockdown_role_id)
+
+        if not lockdown_role:
+            error = "Lockdown role not configured. Use !lockdown setup first" if add else "Lockdown role not configured"
+            return config, [], {user.id: error for user in users}
+
+        # One role edit per user, at most LOCKDOWN_CONCURRENCY in flight
+        semaphore = asyncio.Semaphore(LOCKDOWN_CONCURRENCY)
+        changed, failed = [], {}
+
+        async def apply(user):
+            member = guild.get_member(user.id)
+            if not member:
+                # The member cache can be empty (lean profiles, or before chunking finishes)
+                try:
+                    async with semaphore, self.rest.slot(CONTAINMENT):
+                        member = await guild.fetch_member(user.id)
+                except discord.NotFound:
+                    failed[user.id] = NOT_IN_SERVER
+                    return
+                except discord.HTTPException as e:
+                    failed[user.id] = f"Could not fetch member: {str(e)}"
+                    return
+            has_role = lockdown_role in member.roles
+            if has_role == add:
+                changed.append(user.id)
+                return
+            async with semaphore, self.rest.slot(CONTAINMENT):
+                try:
+                    if add:
+                        await member.add_roles(lockdown_role, reason=reason)
+                    else:
+                        await member.remove_roles(lockdown_role, reason=reason)
+                    changed.append(user.id)
+                except Exception as e:
+                    action = "lock down" if add else "unlock"
+                    failed[user.id] = f"Failed to {action} user: {str(e)}"
+
+        unique = {user.id: user for user in users}
+        await asyncio.gather(*(apply(user) for user in unique.values()))
+        return config, changed, failed
+
+    async def _edit_channels(self, edits):
+        """Run (channel, overwrite, reason) edits on @everyone with bounded concurrency; returns (done, failed)"""
+        semaphore = asyncio.Semaphore(CHANNEL_EDIT_CONCURRENCY)
+        done = failed = 0
+
+        async def apply(channel, overwrite, reason):
+            nonlocal done, failed
+            async with semaphore, self.rest.slot(CONTAINMENT):
+                try:
+                    await channel.set_permissions(channel.guild.default_role, overwrite=overwrite, reason=reason)
+                    done += 1
+                except Exception:
+                    failed += 1
+
+        await asyncio.gather(*(apply(*edit) for edit in edits))
+        return done, failed
+
+    async def lock_channels(self, guild, reason="Anti-Raid: Server lockdown"):
+        """Deny send_messages for @everyone on every text channel, snapshotting what it replaces"""
+        everyone = guild.default_role
+        snapshot = {}
+        edits = []
+        for channel in guild.text_channels:
+            overwrite = channel.overwrites.get(everyone)
+            if overwrite is not None and overwrite.send_messages is False:
+                continue  # already denied, nothing to change or restore
+            # Stored as the raw (allow, deny) pair, or None when there was no overwrite
+            snapshot[str(channel.id)] = [v.value for v in overwrite.pair()] if overwrite is not None else None
+            locked = discord.PermissionOverwrite.from_pair(*overwrite.pair()) if overwrite is not None else discord.PermissionOverwrite()
+            locked.send_messages = False
+            edits.append((channel, locked, reason))
+
+        # Persist before editing so an interrupted lockdown can still be undone exactly
+        async with self.db() as db:
+            # Channels a previous unlock failed to restore keep their original values
+            async with db.execute('SELECT data FROM lockdown_snapshot WHERE guild_id = ?', (guild.id,)) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                snapshot.update(json.loads(row[0]))
+            await db.execute('''
+                INSERT OR REPLACE INTO lockdown_snapshot (guild_id, data, created_at)
+                VALUES (?, ?, ?)
+            ''', (guild.id, json.dumps(snapshot, separators=(',', ':')), datetime.utcnow().isoformat()))
+            await db.commit()
+
+        return await self._edit_channels(edits)
+
+    async def unlock_channels(self, guild, reason="Anti-Raid: Lockdown lifted"):
+        """Put back the snapshotted @everyone overwrites, touching only channels that differ"""
+        everyone = guild.default_role
+        async with self.db() as db:
+            async with db.execute('SELECT data FROM lockdown_snapshot WHERE guild_id = ?', (guild.id,)) as cursor:
+                row = await cursor.fetchone()
+
+        edits = []
+        if row:
+            for channel_id, pair in json.loads(row[0]).items():
+                channel = guild.get_channel(int(channel_id))
+                if channel is None:
+                    continue
+                current = channel.overwrites.get(everyone)
+                current_pair = [v.value for v in current.pair()] if current is not None else None
+                if current_pair == pair:
+                    continue
+                overwrite = None
+                if pair is not None:
+                    overwrite = discord.PermissionOverwrite.from_pair(discord.Permissions(pair[0]), discord.Permissions(pair[1]))
+                edits.append((channel, overwrite, reason))
+        else:
+            # Lockdown predates snapshots: only clear the deny it would have set
+            for channel in guild.text_channels:
+                overwrite = channel.overwrites.get(everyone)
+                if overwrite is not None and overwrite.send_messages is False:
+                    overwrite.send_messages = None
+                    edits.append((channel, None if overwrite.is_empty() else overwrite, reason))
+
+        done, failed = await self._edit_channels(edits)
+        if not failed:
+            async with self.db() as db:
+                await db.execute('DELETE FROM lockdown_snapshot WHERE guild_id = ?', (guild.id,))
+                await db.commit()
+        return done, failed
+
+    async def get_raid_snapshot(self, guild_id):
+        async with self.db() as db:
+            async with db.execute('SELECT snapshot FROM raid_mode WHERE guild_id = ?', (guild_id,)) as cursor:
+                row = await cursor.fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def enable_raid_mode(self, guild, reason="Anti-Raid: Raid mode"):
+        """Close the guild with a few guild-level edits; returns (bool, msg)"""
+        if await self.get_raid_snapshot(guild.id):
+            return False, "Raid mode is already active"
+
+        everyone = guild.default_role
+        snapshot = {
+            'verification_level': guild.verification_level.value,
+            'invites_disabled': 'INVITES_DISABLED' in guild.features,
+            'everyone_permissions': everyone.permissions.value
+        }
+        # Persist first so a crash half way through can still be undone
+        async with self.db() as db:
+            await db.execute('''
+                INSERT OR REPLACE INTO raid_mode (guild_id, snapshot, started_at)
+                VALUES (?, ?, ?)
+            ''', (guild.id, json.dumps(snapshot), datetime.utcnow().isoformat()))
+            await db.commit()
+
+        try:
+            async with self.rest.slot(CONTAINMENT):
+                await guild.edit(
+                    verification_level=max(guild.verification_level, RAID_MODE_VERIFICATION, key=lambda v: v.value),
+                    invites_disabled=True,
+                    reason=reason
+                )
+                await everyone.edit(
+                    permissions=discord.Permissions(everyone.permissions.value & ~RAID_MODE_DENY.value),
+                    reason=reason
+                )
+        except Exception as e:
+            await self.disable_raid_mode(guild, "Anti-Raid: Raid mode rollback")
+            return False, f"Failed to enable raid mode: {str(e)}"
+        return True, "Raid mode enabled"
+
+    async def disable_raid_mode(self, guild, reason="Raid mode lifted"):
+        """Put back the exact verification level, invite state and @everyone permissions"""
+        snapshot = await self.get_raid_snapshot(guild.id)
+        if not snapshot:
+            return False, "Raid mode is not active"
+
+        try:
+            async with self.rest.slot(CONTAINMENT):
+                await guild.edit(
+                    verification_level=discord.VerificationLevel(snapshot['verification_level']),
+                    invites_disabled=snapshot['invites_disabled'],
+                    reason=reason
+                )
+                if guild.default_role.permissions.value != snapshot['everyone_permissions']:
+                    await guild.default_role.edit(
+                        permissions=discord.Permissions(snapshot['everyone_permissions']),
+                        reason=reason
+                    )
+        except Exception as e:
+            return False, f"Failed to disable raid mode: {str(e)}"
+
+        async with self.db() as db:
+            await db.execute('DELETE FROM raid_mode WHERE guild_id = ?', (guild.id,))
+            await db.commit()
+        return True, "Raid mode disabled"
+
+    async def sync_lockdown_overwrite(self, channel, role, reason="Guardian lockdown sync"):
+        """Write the lockdown deny overwrite to a channel only if it differs; True if patched"""
+        if channel.overwrites_for(role) == LOCKDOWN_OVERWRITE:
+            return False
+        async with self.rest.slot(CONTAINMENT):
+            await channel.set_permissions(role, overwrite=LOCKDOWN_OVERWRITE, reason=reason)
+        return True
+
+    async def reconcile_lockdown_overwrites(self, guild, reason="Guardian lockdown sync"):
+        """Patch channels whose lockdown-role overwrite drifted; returns (checked, patched, failed)"""
+        config = await self.get_config(guild.id)
+        role = guild.get_role(config.lockdown_role_id) if config.lockdown_role_id else None
+        if not role:
+            return 0, 0, 0
+
+        patched = failed = 0
+        for channel in guild.channels:
+            try:
+                if await self.sync_lockdown_overwrite(channel, role, reason):
+                    patched += 1
+            except Exception:
+                failed += 1
+        return len(guild.channels), patched, failed
+
+    async def lockdown_users(self, guild, users, reason="Anti-Raid", duration=None):
+        """Lock down many users at once; locked_users is written in a single save"""
+        config, locked, failed = await self._apply_lock_role(guild, users, True, reason)
+        if locked:
+            config.locked_users.update(locked)
+            await config.save()
+            if duration:
+                await self.schedule_unlocks(guild.id, locked, datetime.utcnow() + duration)
+            else:
+                await self.cancel_unlocks(guild.id, locked)
+        return locked, failed
+
+    async def unlock_users(self, guild, users, reason="Unlocked by admin"):
+        """Unlock many users at once; locked_users is written in a single save"""
+        config, unlocked, failed = await self._apply_lock_role(guild, users, False, reason)
+        if unlocked:
+            config.locked_users.difference_update(unlocked)
+            await config.save()
+            await self.cancel_unlocks(guild.id, unlocked)
+        return unlocked, failed
+
+    async def lockdown_user(self, guild, user, reason="Anti-Raid", duration=None):
+        """Lock down a user - make them invisible (Wick-style)"""
+        locked, failed = await self.lockdown_users(guild, [user], reason, duration)
+        if locked:
+            return True, "User locked down successfully"
+        return False, failed[user.id]
+
+    async def unlock_user(self, guild, user):
+        """Unlock a user from lockdown"""
+        unlocked, failed = await self.unlock_users(guild, [user])
+        if unlocked:
+            return True, "User unlocked successfully"
+        return False, failed[user.id]